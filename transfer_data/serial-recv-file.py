@@ -13,6 +13,16 @@ import signal
 import atexit
 import pwd
 import grp
+import json
+import socket
+import sqlite3
+import struct
+import threading
+import zlib
+import gzip
+import select
+import errno
+from multiprocessing.pool import ThreadPool
 
 logger = logging.getLogger(__name__)
 LOGFILEDIR = '/var/lib/sierra'
@@ -24,11 +34,58 @@ ENDFNAMESTRING = b'' + '<<ENDFNAME>>'.encode()
 EOFSTRING = b'' + "<<EOF>>\n".encode()
 ENDSTRING = b'' + '<<DONE>>'.encode()
 SERVERALIVESTRING = b'' + 'Server Alive\n'.encode()
+HASHSTRING = b'' + '<<HASH>>'.encode()
+ENDHASHSTRING = b'' + '<<ENDHASH>>'.encode()
+HELLOSTRING = b'' + '<<HELLO>>'.encode()
+ENDHELLOSTRING = b'' + '<<ENDHELLO>>'.encode()
+METASTRING = b'' + '<<META>>'.encode()
 SERVERALIVE = 0
 
 BAUD = 921600
 OUTPUTDIR = '/opt/sierra/file_uploader/uploads/outgoing'
 TEMPDIR = '/opt/sierra/serial_receive_tmp'
+UPLOADERSOCKET = '/tmp/fileuploader.sock' # File uploader listens here for newly published files
+UPLOADERQUEUE = '/var/lib/sierra/fileuploader.db' # File uploader's queue - files it is working on are not moved to or from COLDSPOOL
+CUTTHROUGH = False # Report progress so the uploader can upload files while they are still being received
+CUTTHROUGHBLOCK = 4 * 1024 * 1024 # Bytes received between progress reports
+HASHWORKERS = 4 # Threads hashing Merkle tree leaves
+MERKLELEAFSIZE = 1024 * 1024
+POSTWORKERS = 2 # Threads publishing received files while the next one is received
+DECOMPRESS = False # Publish received .gz files decompressed (done by the POSTWORKERS)
+RESULTHOLD = 1 # Seconds the transfer result is held on RTS/DTR for the server to read
+RESUME = False # Keep a journal per received file so an interrupted transfer can resume
+RESUMEBLOCK = 256 * 1024 # Bytes received between syncs of the file and its journal
+JOURNALSUFFIX = '.journal' # Journal of TEMPDIR/name.part is TEMPDIR/name.part.journal
+SEGMENTSTORESUFFIX = '.segments' # Segments received of TEMPDIR/name.part (kept as name.part.seg<N>)
+PUBLISHLOCK = threading.Lock() # Held while logs are copied to the uploader
+
+# Backpressure - new transfers are deferred before the disk fills (Capacity), the server waits meanwhile
+FREEMINIMUM = 512 * 1024 * 1024 # Free Bytes on the TEMPDIR/OUTPUTDIR disk(s) below which transfers are deferred - keep above the largest file sent
+FREERESUME = 1024 * 1024 * 1024 # Free Bytes needed before deferred transfers resume
+SPOOLLIMIT = 0 # Bytes waiting for upload in OUTPUTDIR above which transfers are deferred (0 = no limit)
+SPOOLRESUME = 0 # Bytes waiting in OUTPUTDIR below which deferred transfers resume
+CAPACITYINTERVAL = 30 # Seconds between checks while transfers are deferred
+COLDSPOOL = '' # Folder (ideally on another disk) the oldest waiting uploads are moved to, compressed, while deferring ('' = off)
+
+# Capability negotiation - the server offers its features in a HELLO when it starts
+BITTIME = 0.05 # Seconds each half of an answer bit is held on the modem lines
+PROTOCOLVERSION = 1 # Framing version
+SESSIONFILE = os.path.join(LOGFILEDIR, 'session.json') # Last session agreed, used again after a restart
+
+# Channel multiplexing (accepted if the server offers it; used from startup if no server negotiated yet)
+MULTIPLEX = False
+MUXMAGIC = b'\xa5\x5a' # Start of every frame
+MUXHEADER = struct.Struct('>2sBH') # Magic, channel, payload length - followed by payload and CRC32
+MUXFRAMESIZE = 1536 # Largest frame payload
+CONTROLCHANNEL = 0 # Handshakes, file names and hashes
+HEARTBEATCHANNEL = 1 # Heartbeats, telemetry and status messages
+DATACHANNEL = 2 # File contents
+LOGCHANNEL = 3 # Low priority log lines
+LINKBUFFERLIMIT = 1024 * 1024 # Bytes of control/file data buffered before reading pauses
+MESSAGESETTLE = 0.02 # Seconds the line must be quiet after a burst of data before it is read as one message
+REMOTELOGNAME = 'log-remote-{}.txt' # Log lines streamed by the sender, per source, in LOGFILEDIR
+LOGPUBLISHINTERVAL = 3600 # Seconds between copies of the logs to the uploader (sooner after a failed transfer)
+LASTPUBLISHED = {} # Log file -> time it was last copied to the uploader
 
 def configure_logging():
     logger.setLevel(logging.DEBUG)
@@ -50,53 +107,218 @@ def configure_logging():
         logger.critical('Error accessing log file{}.  Exiting.\n\tException Message: {}'.format(LOGFILENAME, e))
         sys.exit()
 
-def filehash(filepath):
+class CRC32Hash(object):
     '''
-    Calculate and return the MD5 hash of the file
+    hashlib style wrapper around zlib.crc32
+    Very fast, for catching transmission errors in blocks (not tamper-proof)
+    '''
+
+    name = 'crc32'
+
+    def __init__(self, data=b''):
+        self.crc = 0
+        self.update(data)
+
+    def update(self, data):
+        self.crc = zlib.crc32(data, self.crc) & 0xffffffff
+
+    def hexdigest(self):
+        return '{:08x}'.format(self.crc)
+
+class MerkleHash(object):
+    '''
+    Tree hash - the file is split into [leafsize] leaves that are hashed
+     separately, so large files can be hashed on several cores and a damaged
+     range can be located, and the root is the hash of the leaf digests
+    hexdigest() returns "leafalgorithm:leafsize:root:leaf,leaf,..."
+    '''
+
+    name = 'merkle'
+
+    def __init__(self, leafalgorithm=None, leafsize=MERKLELEAFSIZE):
+        self.leafalgorithm = leafalgorithm or ('blake2b' if 'blake2b' in HASHES else 'md5')
+        self.leafsize = leafsize
+        self.leaves = []
+        self.leaf = newhash(self.leafalgorithm)
+        self.leafbytes = 0
+
+    def update(self, data):
+        pos = 0
+        while pos < len(data):
+            take = min(len(data) - pos, self.leafsize - self.leafbytes)
+            self.leaf.update(data[pos:pos + take])
+            self.leafbytes += take
+            pos += take
+            if self.leafbytes == self.leafsize:
+                self.leaves.append(self.leaf.hexdigest())
+                self.leaf = newhash(self.leafalgorithm)
+                self.leafbytes = 0
+
+    def hexdigest(self):
+        leaves = list(self.leaves)
+        if self.leafbytes or not leaves:
+            leaves.append(self.leaf.hexdigest())
+        root = newhash(self.leafalgorithm)
+        root.update(','.join(leaves).encode())
+        return '{}:{}:{}:{}'.format(self.leafalgorithm, self.leafsize, root.hexdigest(), ','.join(leaves))
+
+HASHES = {'md5': hashlib.md5, 'crc32': CRC32Hash, 'merkle': MerkleHash}
+if hasattr(hashlib, 'blake2b'): # Python 3.6+
+    HASHES['blake2b'] = hashlib.blake2b
+    HASHES['blake2s'] = hashlib.blake2s
+
+def newhash(algorithm):
+    '''
+    Return a new hash object for [algorithm] (a key of HASHES)
+    Raises ValueError if the algorithm is not available on this system
+    '''
+
+    try:
+        return HASHES[algorithm]()
+    except KeyError:
+        raise ValueError('Hash algorithm "{}" is not available'.format(algorithm))
+
+def filehash(filepath, algorithm='md5', leafalgorithm=None, leafsize=MERKLELEAFSIZE):
+    '''
+    Calculate and return the hash of the file (hex digest)
+    Merkle tree leaves are hashed in parallel by HASHWORKERS threads
     '''
 
     blocksize = 64*1024
-    
-    md5 = hashlib.md5()
+
+    if algorithm == 'merkle':
+        tree = MerkleHash(leafalgorithm, leafsize)
+        offsets = range(0, os.path.getsize(filepath), tree.leafsize)
+        pool = ThreadPool(HASHWORKERS)
+        try:
+            tree.leaves = pool.map(lambda offset: leafhash(filepath, offset, tree.leafsize, tree.leafalgorithm), offsets)
+        finally:
+            pool.close()
+            pool.join()
+        return tree.hexdigest()
+
+    hasher = newhash(algorithm)
     with open(filepath, 'rb') as fp:
         while True:
             data = fp.read(blocksize)
             if not data:
                 break
 
-            md5.update(data)
-    return md5.hexdigest()
+            hasher.update(data)
+    return hasher.hexdigest()
+
+def leafhash(filepath, offset, leafsize, algorithm):
+    '''
+    Hash one Merkle tree leaf ([leafsize] bytes from [offset]) of the file
+    '''
+
+    hasher = newhash(algorithm)
+    with open(filepath, 'rb') as fp:
+        fp.seek(offset)
+        hasher.update(fp.read(leafsize))
+    return hasher.hexdigest()
 
-def recvfile(connection, filename, starttime):
+def waitforinput(connection, timeout=None, size=1):
+    '''
+    Block until at least [size] bytes are waiting on [connection] or [timeout]
+     seconds pass (None waits forever) and return the number of bytes waiting
+    Sleeps in select() on the serial port instead of polling inWaiting(), so
+     an idle receiver uses no CPU and wakes as soon as data arrives
+    '''
+
+    if hasattr(connection, 'waitforinput'):
+        return connection.waitforinput(timeout, size)
+
+    deadline = None if timeout is None else time.time() + timeout
+    while True:
+        waiting = connection.inWaiting()
+        remaining = None if deadline is None else deadline - time.time()
+        if waiting >= size or (remaining is not None and remaining <= 0):
+            return waiting
+
+        if waiting > 0:
+            # Some of it is here - sleep about as long as the rest takes to arrive
+            delay = (size - waiting) * 10.0 / BAUD
+            time.sleep(delay if remaining is None else min(delay, remaining))
+        else:
+            try:
+                select.select([connection], [], [], remaining)
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+
+def waitformessage(connection, timeout=None):
+    '''
+    Wait for incoming data, then for the line to go quiet for MESSAGESETTLE
+     seconds so a message the server wrote in one go is read whole
+    Returns the number of bytes waiting (0 on timeout)
+    '''
+
+    waiting = waitforinput(connection, timeout)
+    while waiting > 0:
+        more = waitforinput(connection, MESSAGESETTLE, waiting + 1)
+        if more == waiting:
+            break
+        waiting = more
+
+    return waiting
+
+def recvfile(connection, filename, starttime, hasher=None, offset=0, journal=None, segment=False):
     '''
     Reads incoming data and writes it to the local file
+    Data written is also fed to [hasher] (if given), so the file does not
+     have to be read again to verify it
+    When resuming, the data arrives from [offset] and the file up to there is
+     kept.  DTR (offset accepted) is held until the first data arrives, so
+     the server has read it whenever it polls.  With a [journal] entry the
+     file is synced and the offset recorded in its journal every RESUMEBLOCK bytes
     Provides periodic status update (bytes recvd / transfer rate)
     Detects end of file and invalid data
     Timeout if data transfer stalls
+    With CUTTHROUGH, reports every CUTTHROUGHBLOCK bytes written to the
+     uploader so it can upload the file while the rest is still arriving
+     (not for a [segment] of a file, which is uploaded once assembled)
     '''
 
     chunkcount = 0
     bytestatus = 1000 #Log status every x KB
-    totalbytes = 0
+    totalbytes = offset
     recvdatalen = 0
-    nullbytelimit = 100
-    nullbytecount = 0
-    nullsleeptime = 0.05
     nulltimeout = 15 # Timeout in seconds
     transfererror = False
     lastwriteline = ''
     lastupdate = ''
 
     connection.rtscts = True
+    outputfile = outputname(filename, os.path.dirname(filename))
     filename = os.path.normpath(os.path.join(TEMPDIR, filename))
     folderinit(os.path.dirname(filename), 'Receive folder/subfolder')
     logger.info('Writing to: {}'.format(filename))
 
-    with open(filename, "wb") as outfile:
+    transfer = str(starttime)
+    reportedbytes = 0
+    cutthrough = CUTTHROUGH and not segment
+    if cutthrough:
+        notifyuploader('receiving', filename, dest=outputfile, offset=0, transfer=transfer)
+
+    if journal is not None:
+        savejournal(filename + JOURNALSUFFIX, dict(journal, offset=offset))
+
+    deadline = time.time() + nulltimeout
+    with open(filename, "r+b" if offset else "wb") as outfile:
+       if offset:
+           outfile.truncate(offset)
+           while hasher is not None and outfile.tell() < offset:
+               hasher.update(outfile.read(min(offset - outfile.tell(), 1024 * 1024)))
+           outfile.seek(offset)
+
        while True:
-            recvdatalen = connection.inWaiting()
+            recvdatalen = waitforinput(connection, deadline - time.time())
 
             if recvdatalen > 0:
+                if offset and chunkcount == 0:
+                    connection.setDTR(0) # The server is sending from the accepted offset
+                deadline = time.time() + nulltimeout
                 line = connection.read(recvdatalen)
                 totalbytes += len(line)
                 chunkcount += 1
@@ -116,6 +338,8 @@ def recvfile(connection, filename, starttime):
 
                     if line[-8:] == EOFSTRING:
                         outfile.write(line[:-8])
+                        if hasher is not None:
+                            hasher.update(line[:-8])
                         totalbytes -= (8 + 0) # Don't count the EOFSTRING - it isn't part of the file
                         logger.debug('\tEOF last 8 characters of line {}'.format(line, lastwriteline))
                         break
@@ -128,8 +352,20 @@ def recvfile(connection, filename, starttime):
                 if line != b'':
                     logger.debug('{:,}. ({:,} Bytes) {}'.format(chunkcount, totalbytes, str(line[0:5]) + ' ... ' + str(line[-5:])))
                     outfile.write(line)
+                    if hasher is not None:
+                        hasher.update(line)
                     lastwriteline = line
-                    nullbytecount = 0
+
+                    if journal is not None and totalbytes // RESUMEBLOCK != (totalbytes - len(line)) // RESUMEBLOCK:
+                        outfile.flush()
+                        os.fsync(outfile.fileno())
+                        savejournal(filename + JOURNALSUFFIX, dict(journal, offset=totalbytes))
+
+                    if cutthrough and totalbytes - reportedbytes >= CUTTHROUGHBLOCK:
+                        outfile.flush()
+                        reportedbytes = totalbytes
+                        # The last bytes may be the start of a split EOFSTRING - don't report them yet
+                        notifyuploader('receiving', filename, dest=outputfile, offset=totalbytes - len(EOFSTRING), transfer=transfer)
                 
                 if INITSTRING in line:
                     raise ValueError('Server sending InitString "{}" in middle of transfer.  Client/Server out of sync!!'.format(INITSTRING))
@@ -143,11 +379,7 @@ def recvfile(connection, filename, starttime):
                 time.sleep(0.001) # For some reason, this sleep actually increases transfer rate noticeably 
 
             else:
-                nullbytecount += 1
-                if nullbytecount >= (nulltimeout / nullsleeptime): #nullbytelimit:
-                    raise Exception('WARNING: No data received for {} seconds. Transmission failed or completed undetected.  Transfer aborted.'.format(nulltimeout))
-
-                time.sleep(nullsleeptime) # This seems to be necessary
+                raise Exception('WARNING: No data received for {} seconds. Transmission failed or completed undetected.  Transfer aborted.'.format(nulltimeout))
 
     connection.rtscts = False
 
@@ -180,9 +412,9 @@ def isinvalidmsg(message):
 
     return False
 
-def checkforstring(connection, string, sleeptime):
+def checkforstring(connection, string):
     '''
-    Loops until requested string is found or the timeout is reached
+    Waits until requested string is found
     Logs Server Update messages
     Checks for invalid messages
     '''
@@ -191,8 +423,13 @@ def checkforstring(connection, string, sleeptime):
     
     # Loop until requested string found
     while True:
+        waitformessage(connection)
         incomingdata = connection.readline(connection.inWaiting())
-        if incomingdata != string:
+        if HELLOSTRING in incomingdata:
+            negotiate(connection, incomingdata)
+            if string != INITSTRING:
+                raise Exception('Server restarted (HELLO received while waiting for {})'.format(string))
+        elif incomingdata != string:
             if incomingdata != b'':
                 logger.debug('Waiting for String ({}),  Received {}'.format(string, incomingdata))
                 if incomingdata == SERVERALIVESTRING:
@@ -203,14 +440,236 @@ def checkforstring(connection, string, sleeptime):
                     pass
 
                 isinvalidmsg(incomingdata) # Check if invalid message received
-
-                time.sleep(0.05) # If data received, sleep shorter to clear out queue
-            else:
-                time.sleep(sleeptime)
         else:
             logger.info('String ({}) received'.format(string))
             return 1      
 
+def negotiate(connection, data):
+    '''
+    Answer the HELLO a server sends when it starts: one bit per offered
+     feature, set if this receiver supports it (signalbits), and switch the
+     link to the agreed framing
+    The session is saved in SESSIONFILE so a restarted receiver carries on
+     with the same framing
+    '''
+
+    deadline = time.time() + 5
+    while ENDHELLOSTRING not in data:
+        if waitforinput(connection, deadline - time.time()) < 1:
+            raise Exception('Timeout waiting for end of HELLO.  {} characters received.'.format(len(data)))
+        data += connection.read(connection.inWaiting())
+
+    hello = json.loads(data[data.index(HELLOSTRING) + len(HELLOSTRING):data.index(ENDHELLOSTRING)].decode())
+    features = hello.get('features', [])
+    bits = [acceptfeature(feature, hello) for feature in features]
+    session = {'mux': 'mux' in [feature for feature, bit in zip(features, bits) if bit]}
+    logger.info('Server HELLO {}\n\tAccepted: {}'.format(hello, [feature for feature, bit in zip(features, bits) if bit]))
+
+    connection.framed = session['mux']
+    savejournal(SESSIONFILE, session)
+    signalbits(connection, bits)
+
+    return session
+
+def acceptfeature(feature, hello):
+    '''
+    True if this receiver supports [feature] from the server's HELLO
+    '''
+
+    if feature == 'mux':
+        return MULTIPLEX and hello.get('version') == PROTOCOLVERSION and hello.get('framesize', 0) <= MUXFRAMESIZE
+    if feature == 'resume':
+        return RESUME
+    if feature in ('zlib', 'segments'):
+        return True
+    if feature.startswith('hash:'):
+        if feature == 'hash:merkle':
+            return hello.get('merkleleaf') in HASHES
+        return feature[5:] in HASHES
+    return False
+
+def signalbits(connection, bits):
+    '''
+    Send [bits] to the server over the modem lines: each bit is set on RTS
+     and then clocked by toggling DTR (the server reads CTS when DSR changes)
+    '''
+
+    clock = 0
+    for bit in bits:
+        connection.setRTS(1 if bit else 0)
+        time.sleep(BITTIME)
+        clock ^= 1
+        connection.setDTR(clock)
+        time.sleep(BITTIME)
+
+    connection.setRTS(0)
+    connection.setDTR(0)
+
+    return
+
+class ChannelLink(threading.Thread):
+    '''
+    Receiving end of the sender's channel multiplexer (MULTIPLEX)
+    Reads frames from the serial port on its own thread, checks their CRC32
+     and hands heartbeats, status messages and log lines to their handlers
+     as soon as they arrive, even in the middle of a transfer.  Control and
+     file data frames are buffered in order and read through the same
+     inWaiting(), read() and readline() calls as the serial port, so the
+     transfer code works unchanged.  Reading stops while LINKBUFFERLIMIT
+     bytes are buffered so hardware flow control still holds the sender back.
+    Anything else (modem lines, open/close) is passed to the serial port.
+    Unless [framed] (no multiplexing agreed, see negotiate) bytes are buffered
+     as they arrive.  A HELLO outside frames means the server restarted, and
+     unframed bytes are buffered from there on until it negotiates again.
+    '''
+
+    def __init__(self, ser, framed=True):
+        super(ChannelLink, self).__init__()
+        self.daemon = True
+        self.ser = ser
+        self.framed = framed
+        self.buffer = bytearray()
+        self.cond = threading.Condition()
+        self.handlers = {HEARTBEATCHANNEL: self.heartbeat, LOGCHANNEL: self.logline}
+
+    def __getattr__(self, name):
+        return getattr(self.ser, name)
+
+    @property
+    def rtscts(self):
+        return self.ser.rtscts
+
+    @rtscts.setter
+    def rtscts(self, value):
+        self.ser.rtscts = value
+
+    def run(self):
+        pending = b''
+        while True:
+            try:
+                with self.cond:
+                    while len(self.buffer) > LINKBUFFERLIMIT:
+                        self.cond.wait()
+                data = self.ser.read(max(self.ser.inWaiting(), 1))
+                if self.framed:
+                    pending = self.parse(pending + data)
+                else:
+                    self.dispatch(DATACHANNEL, pending + data)
+                    pending = b''
+            except Exception as e:
+                logger.critical('Exception reading from serial port.\n\tException Message: {}'.format(e))
+                time.sleep(1)
+
+    def parse(self, pending):
+        '''
+        Dispatch every complete frame in [pending] and return what is left
+        Bytes outside frames and frames failing the CRC check are dropped
+        '''
+
+        while True:
+            start = pending.find(MUXMAGIC)
+            hello = pending.find(HELLOSTRING, 0, len(pending) if start < 0 else start)
+            if hello >= 0:
+                logger.info('Server HELLO outside frames. Link unframed until it negotiates.')
+                self.framed = False
+                self.dispatch(DATACHANNEL, pending[hello:])
+                return b''
+            if start < 0:
+                return pending[-(len(HELLOSTRING) - 1):] # May be the start of MUXMAGIC or HELLOSTRING
+            if start > 0:
+                logger.debug('Skipping {} bytes outside frames'.format(start))
+                pending = pending[start:]
+            if len(pending) < MUXHEADER.size:
+                return pending
+
+            magic, channel, length = MUXHEADER.unpack(pending[:MUXHEADER.size])
+            end = MUXHEADER.size + length + 4
+            if length > MUXFRAMESIZE:
+                pending = pending[1:]
+                continue
+            if len(pending) < end:
+                return pending
+
+            crc = struct.unpack('>I', pending[end - 4:end])[0]
+            if crc != zlib.crc32(pending[:end - 4]) & 0xffffffff:
+                logger.warning('Dropping corrupt frame (channel {}, {} bytes)'.format(channel, length))
+                pending = pending[1:]
+                continue
+
+            self.dispatch(channel, pending[MUXHEADER.size:end - 4])
+            pending = pending[end:]
+
+    def dispatch(self, channel, payload):
+        if channel in self.handlers:
+            self.handlers[channel](payload)
+        else:
+            with self.cond:
+                self.buffer.extend(payload)
+                self.cond.notify_all()
+
+    def heartbeat(self, payload):
+        message = payload.decode('utf-8', 'replace')
+        try:
+            status = json.loads(message)
+        except ValueError:
+            status = None
+
+        if isinstance(status, dict):
+            serveralive()
+            logger.debug('Server heartbeat: {}'.format(status))
+        else:
+            logger.info(message)
+
+    def logline(self, payload):
+        '''
+        Append log lines shipped by the sender to the log of their source
+        '''
+
+        try:
+            source, lines = payload[1:].split(b'\0', 1)
+            if payload[:1] == b'z':
+                lines = zlib.decompress(lines)
+            source = ''.join(c for c in source.decode('utf-8', 'replace') if c.isalnum() or c in '-_')
+            appendlog(os.path.join(LOGFILEDIR, REMOTELOGNAME.format(source)), lines)
+        except Exception as e:
+            logger.warning('Shipped log lines could not be saved.\n\tException Message: {}'.format(e))
+
+    def inWaiting(self):
+        return len(self.buffer)
+
+    def waitforinput(self, timeout=None, size=1):
+        deadline = None if timeout is None else time.time() + timeout
+        with self.cond:
+            while len(self.buffer) < size:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            return len(self.buffer)
+
+    def read(self, size=1):
+        with self.cond:
+            while len(self.buffer) < size:
+                self.cond.wait()
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+            self.cond.notify_all()
+        return data
+
+    def readline(self, size=-1):
+        with self.cond:
+            while True:
+                end = self.buffer.find(b'\n') + 1
+                if end or (size >= 0 and len(self.buffer) >= size):
+                    break
+                self.cond.wait()
+            if size >= 0 and (not end or end > size):
+                end = size
+            data = bytes(self.buffer[:end])
+            del self.buffer[:end]
+            self.cond.notify_all()
+        return data
+
 def serveralive():
     print('Server Alive message received')
     SERVERALIVE = 1
@@ -218,26 +677,20 @@ def serveralive():
 
 def checkforfilename(connection):
     '''
-    Get the file name sent by the server and return the file name / folder
+    Get the file name sent by the server and return the file name / folder /
+     META fields (a dict, from a METASTRING block after the name, if any)
     Captures ends when ENDFNAMESTRING is received. Reports timeout error if not received
     '''
 
-    filename = ''
-    sleeptime = 1
+    filename = b''
     filenametimeout = 20
-    filenametimeoutcount = 0
 
     while True:
-        if connection.inWaiting() < 1:
-            logger.debug('Waiting for Remote File Name ({} characters received)'.format(connection.inWaiting()))
-            time.sleep(sleeptime)
-            filenametimeoutcount += 1
-            if filenametimeoutcount > (filenametimeout / sleeptime):
-                raise Exception('Timeout waiting for filename.  Filename not received within {} seconds.'.format(filenametimeout / sleeptime))
+        if waitformessage(connection, filenametimeout) < 1:
+            raise Exception('Timeout waiting for filename.  Filename not received within {} seconds.'.format(filenametimeout))
         else:
-            filenametimeoutcount = 0
             filename = filename + connection.read(connection.inWaiting())
-            filename = filename.decode().rstrip('\0')
+            filename = filename.rstrip(b'\0')
             isinvalidmsg(filename) # Checks for reserved string (INITSTRING, etc.)
                 
             logger.debug('Filename data received: {}'.format(filename))
@@ -245,44 +698,150 @@ def checkforfilename(connection):
             if ENDFNAMESTRING in filename:
                 logger.info('ENDFNAME string ({}) found'.format(ENDFNAMESTRING))
                 filename = filename[:-12]
+                meta = {}
+                if METASTRING in filename:
+                    filename, fields = filename.split(METASTRING, 1)
+                    meta = dict(field.split('=', 1) for field in fields.decode().split(';') if '=' in field)
+                filename = filename.decode()
                 filename += '.part'
                 subfolder = os.path.dirname(filename)
 
-                return filename, subfolder
-
-            time.sleep(1)
+                return filename, subfolder, meta
 
     return -1
 
 def getremotehash(connection):
     '''
     Read the file hash sent by the server
-    Captures [hashlength] characters and reports timeout error if not received
+    Returns (algorithm, hash).  A hash starting with HASHSTRING names its
+     algorithm and ends with ENDHASHSTRING; anything else is a bare
+     [hashlength] character MD5 hash (older senders).
+    Reports timeout error if the hash is not received
     '''
 
-    remotehash = ''
-    sleeptime = 1
+    remotehash = b''
     hashtimeout = 10
-    hashtimeoutcount = 0
     hashlength = 32
 
-    while True:
-        if connection.inWaiting() < hashlength:
-            logger.debug('Waiting for Remote File Hash ({} characters received)'.format(connection.inWaiting()))
-            time.sleep(sleeptime) # 1
-            hashtimeoutcount += 1
-            if hashtimeoutcount > (hashtimeout / sleeptime):
-                raise Exception('Timeout waiting for remote hash.  Hash not received within {} seconds.'.format(hashtimeout / sleeptime))
+    logger.debug('Waiting for Remote File Hash ({} characters received)'.format(connection.inWaiting()))
+    if waitforinput(connection, hashtimeout, hashlength) < hashlength:
+        raise Exception('Timeout waiting for remote hash.  Hash not received within {} seconds.'.format(hashtimeout))
+
+    remotehash = connection.read(len(HASHSTRING))
+    if remotehash != HASHSTRING:
+        if connection.inWaiting() > hashlength - len(remotehash):
+            logger.warning("Buffer contains {} characters. Expected hash length is only {} characters.".format(connection.inWaiting() + len(remotehash), hashlength))
+        remotehash += connection.read(hashlength - len(remotehash))
+        return 'md5', remotehash.decode().rstrip('\0')
+
+    # Tree hashes carry every leaf digest and can take a while to arrive
+    remotehash = b''
+    while ENDHASHSTRING not in remotehash:
+        if waitforinput(connection, hashtimeout) > 0:
+            remotehash += connection.read(connection.inWaiting())
         else:
-            break
+            raise Exception('Timeout waiting for end of remote hash.  {} characters received.'.format(len(remotehash)))
 
-    if connection.inWaiting() > hashlength:
-        logger.warning("Buffer contains {} characters. Expected hash length is only {} characters.".format(connection.inWaiting(), hashlength))
+    algorithm, remotehash = remotehash[:remotehash.index(ENDHASHSTRING)].decode().split(':', 1)
+    return algorithm, remotehash
 
-    remotehash = connection.readline(hashlength) # connection.inWaiting())
-    remotehash = remotehash.decode().rstrip('\0')
+def savejournal(path, entry):
+    '''
+    Atomically replace the transfer journal at [path] so it survives a power loss
+    '''
 
-    return remotehash
+    with open(path + '.tmp', 'w') as f:
+        json.dump(entry, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(path + '.tmp', path)
+
+def loadjournal(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+def removefile(path):
+    '''
+    Delete [path] if it exists
+    '''
+
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def prefixcrc(path, offset):
+    '''
+    CRC32 (hex) of the first [offset] bytes of the file, or None if it is shorter
+    '''
+
+    crc = 0
+    with open(path, 'rb') as f:
+        while offset > 0:
+            data = f.read(min(offset, 1024 * 1024))
+            if not data:
+                return None
+            crc = zlib.crc32(data, crc)
+            offset -= len(data)
+    return '{:08x}'.format(crc & 0xffffffff)
+
+def resumeoffset(partfile, meta):
+    '''
+    Offset the transfer of [partfile] resumes from (0 to start over)
+    The server's offer (META offset and crc) is accepted only if the journal
+     shows the same file (size and hash id) was synced at least that far and
+     the data on disk up to the offset matches the server's CRC32
+    '''
+
+    offset = int(meta.get('offset', 0))
+    journal = loadjournal(partfile + JOURNALSUFFIX)
+    if not offset or journal is None or not os.path.exists(partfile):
+        return 0
+    if journal.get('size') != meta.get('size') or journal.get('id') != meta.get('id') or journal.get('offset', 0) < offset:
+        logger.info('Journal of "{}" does not allow resuming at {:,} Bytes'.format(partfile, offset))
+        return 0
+    if prefixcrc(partfile, offset) != meta.get('crc'):
+        logger.warning('"{}" does not match the server\'s CRC up to {:,} Bytes. Receiving the whole file.'.format(partfile, offset))
+        return 0
+
+    return offset
+
+def hashspec(algorithm, remotehash):
+    '''
+    (algorithm, leaf algorithm, leaf size) the remote hash was made with
+    '''
+
+    if algorithm == 'merkle':
+        leafalgorithm, leafsize = remotehash.split(':')[:2]
+        return algorithm, leafalgorithm, int(leafsize)
+    return algorithm, None, None
+
+def newfilehash(spec):
+    '''
+    New hash object for a hashspec()
+    '''
+
+    if spec[0] == 'merkle':
+        return MerkleHash(spec[1], spec[2])
+    return newhash(spec[0])
+
+def damagedranges(localhash, remotehash):
+    '''
+    Compare local and remote Merkle tree hashes and return the list of
+     (start, end) byte ranges whose leaves differ
+    '''
+
+    leafsize = int(remotehash.split(':')[1])
+    localleaves = localhash.split(':')[3].split(',')
+    remoteleaves = remotehash.split(':')[3].split(',')
+    ranges = []
+    for leaf in range(max(len(localleaves), len(remoteleaves))):
+        if leaf >= len(localleaves) or leaf >= len(remoteleaves) or localleaves[leaf] != remoteleaves[leaf]:
+            ranges.append((leaf * leafsize, (leaf + 1) * leafsize))
+    return ranges
 
 def getportname():
     '''
@@ -310,7 +869,7 @@ def tempfilecleanup(transferstatus, filename, subfolder):
 
     tempfile = filename
     corruptfile = os.path.normpath(os.path.join(TEMPDIR, subfolder, os.path.basename(filename +'.000')))
-    outputfile = os.path.normpath(os.path.join(OUTPUTDIR, subfolder, os.path.basename(filename)))[:-5]
+    outputfile = outputname(filename, subfolder)
     folderinit(os.path.join(OUTPUTDIR, subfolder), 'Output Folder/Subfolder')
 
     try:
@@ -318,18 +877,386 @@ def tempfilecleanup(transferstatus, filename, subfolder):
             logger.info('Moving temp file "{}" to output folder "{}"'.format(tempfile, os.path.join(OUTPUTDIR, subfolder)))
             shutil.move(tempfile, outputfile)
             chown(outputfile)
+            notifyuploader('published', outputfile)
         else:
             # Eventually delete corrupt files, currently renaming for debugging use
             logger.info('Corrupt temp file "{}"'.format(tempfile))
             #os.remove(tempfile)
             os.rename(tempfile, corruptfile)
             chown(corruptfile)
+            if CUTTHROUGH:
+                notifyuploader('failed', tempfile, dest=outputfile)
 
     except Exception as e:
         logger.critical('Exception cleaning up temp file {}.\n\tException Message: {}'.format(tempfile, e))
 
     return
 
+def outputname(filename, subfolder):
+    '''
+    Name the received (.part) file is published as in the output folder
+    '''
+
+    return os.path.normpath(os.path.join(OUTPUTDIR, subfolder, os.path.basename(filename)))[:-5]
+
+def appendlog(path, data, maxbytes=512000, backupcount=5):
+    '''
+    Append to a log file, rotating it like the RotatingFileHandler of the local logs
+    '''
+
+    if os.path.exists(path) and os.path.getsize(path) + len(data) > maxbytes:
+        for n in range(backupcount - 1, 0, -1):
+            if os.path.exists('{}.{}'.format(path, n)):
+                os.rename('{}.{}'.format(path, n), '{}.{}'.format(path, n + 1))
+        os.rename(path, path + '.1')
+
+    with open(path, 'ab') as f:
+        f.write(data)
+
+def publishlogs(force=False):
+    '''
+    Copy the receive log and the logs shipped by the sender to the uploader
+    Each log is copied at most every LOGPUBLISHINTERVAL seconds, and only if
+     it changed, unless [force] (e.g. after a failed transfer)
+    '''
+
+    with PUBLISHLOCK:
+        remotelogs = [os.path.join(LOGFILEDIR, name) for name in sorted(os.listdir(LOGFILEDIR))
+                      if name.startswith(REMOTELOGNAME.split('{}')[0]) and name.endswith(REMOTELOGNAME.split('{}')[1])]
+        for filename in [LOGFILENAME] + remotelogs:
+            last = LASTPUBLISHED.get(filename, 0)
+            if force or (time.time() - last >= LOGPUBLISHINTERVAL and os.path.getmtime(filename) > last):
+                LASTPUBLISHED[filename] = time.time()
+                logtouploader(filename)
+
+    return
+
+def postreceive(transferstatus, filename, subfolder):
+    '''
+    Work done after a file is received and verified - runs on the
+     POSTWORKERS pool so the next file can be received meanwhile
+    With DECOMPRESS, a .gz file is decompressed before it is published
+    '''
+
+    try:
+        if transferstatus and DECOMPRESS:
+            filename = decompress(filename, subfolder)
+        tempfilecleanup(transferstatus, filename, subfolder)
+        publishlogs(force=not transferstatus)
+    except Exception as e:
+        logger.critical('Exception publishing "{}".\n\tException Message: {}'.format(filename, e))
+
+    return
+
+def decompress(filename, subfolder):
+    '''
+    Decompress the received .gz file [filename] (its .part file in TEMPDIR)
+    Returns the .part file of the decompressed file, or [filename] if it is
+     not a .gz file or cannot be decompressed (it is then published as received)
+    '''
+
+    if not filename.endswith('.gz.part'):
+        return filename
+
+    unpacked = filename[:-len('.gz.part')] + '.part'
+    try:
+        with gzip.open(filename, 'rb') as infile:
+            with open(unpacked, 'wb') as outfile:
+                shutil.copyfileobj(infile, outfile, 1024 * 1024)
+    except (IOError, OSError, EOFError, zlib.error) as e:
+        logger.warning('"{}" could not be decompressed. Publishing it as received.\n\tException Message: {}'.format(filename, e))
+        removefile(unpacked)
+        return filename
+
+    logger.info('Decompressed "{}" ({:,} Bytes to {:,} Bytes)'.format(filename, os.path.getsize(filename), os.path.getsize(unpacked)))
+    os.remove(filename)
+    if CUTTHROUGH:
+        # Published under another name - the upload of the compressed file is abandoned
+        notifyuploader('failed', filename, dest=outputname(filename, subfolder))
+
+    return unpacked
+
+def storesegment(partfile, meta):
+    '''
+    Record a verified segment (partfile.seg<N>) in the segment store of
+     [partfile] and return True once every segment of the file is there
+    Segments of another version of the file (different id or size) are discarded
+    '''
+
+    index = int(meta['seg'])
+    store = loadjournal(partfile + SEGMENTSTORESUFFIX)
+    if store is None or store.get('id') != meta.get('id') or store.get('size') != meta.get('size') or store.get('segs') != meta.get('segs'):
+        for old in (store or {}).get('have', []):
+            if old != index:
+                removefile('{}.seg{}'.format(partfile, old))
+        store = {'id': meta.get('id'), 'size': meta.get('size'), 'segs': meta.get('segs'), 'have': []}
+
+    if index not in store['have']:
+        store['have'].append(index)
+    savejournal(partfile + SEGMENTSTORESUFFIX, store)
+    logger.info('{} of {} segments of "{}" received'.format(len(store['have']), store['segs'], partfile))
+
+    return len(store['have']) == int(store['segs'])
+
+def assemblesegments(partfile, count, size, subfolder):
+    '''
+    Join the [count] segments of [partfile] in order and publish the file
+    Runs on the POSTWORKERS pool like postreceive
+    '''
+
+    try:
+        with open(partfile, 'wb') as outfile:
+            for index in range(count):
+                with open('{}.seg{}'.format(partfile, index), 'rb') as infile:
+                    shutil.copyfileobj(infile, outfile, 1024 * 1024)
+        if os.path.getsize(partfile) != size:
+            raise ValueError('Assembled {:,} Bytes, expected {:,} Bytes'.format(os.path.getsize(partfile), size))
+
+        for index in range(count):
+            removefile('{}.seg{}'.format(partfile, index))
+        removefile(partfile + SEGMENTSTORESUFFIX)
+    except Exception as e:
+        logger.critical('Segments of "{}" could not be assembled.\n\tException Message: {}'.format(partfile, e))
+        return
+
+    logger.info('Assembled "{}" from {} segments'.format(partfile, count))
+    postreceive(True, partfile, subfolder)
+
+    return
+
+def diskfree(path):
+    '''
+    Bytes available to this process on the filesystem holding [path]
+    '''
+
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize
+
+def spoolfiles(folder):
+    '''
+    (modification time, path, size) of every file below [folder]
+    '''
+
+    files = []
+    for dirpath, dirnames, filenames in os.walk(folder):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue # Uploaded and deleted meanwhile
+            files.append((stat.st_mtime, path, stat.st_size))
+
+    return files
+
+class Capacity(object):
+    '''
+    Keeps the receiver from filling its disk when the uploader falls behind
+     (or is offline for days)
+    check() compares the free space of TEMPDIR/OUTPUTDIR and the size of the
+     upload spool (OUTPUTDIR) with FREEMINIMUM and SPOOLLIMIT and tells why new
+     transfers must be deferred.  Once deferring, transfers resume only at
+     FREERESUME and SPOOLRESUME, so the receiver does not flap around one limit.
+    With COLDSPOOL set, the oldest waiting uploads are compressed into the cold
+     spool while deferring (spill) and put back once there is room (restore).
+     Files the uploader is working on (uploaderbusy) are left where they are.
+    '''
+
+    def __init__(self):
+        self.deferring = False
+        self.lock = threading.Lock() # Held while files move to or from COLDSPOOL
+
+    def usage(self):
+        '''
+        Free Bytes (the fuller disk of TEMPDIR and OUTPUTDIR) and Bytes waiting in the upload spool
+        '''
+
+        free = min(diskfree(TEMPDIR), diskfree(OUTPUTDIR))
+        spool = sum(size for mtime, path, size in spoolfiles(OUTPUTDIR)) if SPOOLLIMIT else 0
+        return free, spool
+
+    def reason(self, free, spool, resuming):
+        '''
+        Why transfers must be deferred at [free] and [spool] Bytes (None if they need not be)
+        The resume limits apply when [resuming]
+        '''
+
+        freeneeded, spoollimit = (FREERESUME, SPOOLRESUME) if resuming else (FREEMINIMUM, SPOOLLIMIT)
+        if free < freeneeded:
+            return 'low disk space ({:,} Bytes free, {:,} Bytes needed)'.format(free, freeneeded)
+        if SPOOLLIMIT and spool > spoollimit:
+            return 'upload spool full ({:,} Bytes waiting, limit {:,} Bytes)'.format(spool, spoollimit)
+        return None
+
+    def check(self):
+        '''
+        Returns why new transfers must be deferred, or None if they can go ahead
+        '''
+
+        reason = self.reason(*self.usage(), resuming=self.deferring)
+        if reason is not None and COLDSPOOL and self.spill():
+            reason = self.reason(*self.usage(), resuming=True)
+        self.deferring = reason is not None
+
+        return reason
+
+    def spill(self):
+        '''
+        Compress the oldest files waiting in OUTPUTDIR into COLDSPOOL (same
+         subfolders, .gz added) until transfers could resume
+        Returns the number of files moved
+        '''
+
+        moved = 0
+        with self.lock:
+            free, spool = self.usage()
+            busy = uploaderbusy()
+            for mtime, path, size in sorted(spoolfiles(OUTPUTDIR)):
+                if self.reason(free, spool, True) is None:
+                    break
+                if diskfree(COLDSPOOL) < size + FREEMINIMUM:
+                    logger.warning('Cold spool "{}" is full'.format(COLDSPOOL))
+                    break
+                if os.path.realpath(path) in busy or os.path.basename(path).startswith('.'):
+                    continue
+
+                coldfile = os.path.join(COLDSPOOL, os.path.relpath(path, OUTPUTDIR)) + '.gz'
+                folderinit(os.path.dirname(coldfile), 'Cold spool subfolder')
+                # Dot files are skipped by the uploader, and an upload queued meanwhile finds the file gone
+                hidden = os.path.join(os.path.dirname(path), '.' + os.path.basename(path))
+                try:
+                    os.rename(path, hidden)
+                except OSError as e:
+                    # Most likely uploaded and deleted meanwhile
+                    logger.warning('"{}" not moved to the cold spool.\n\tException Message: {}'.format(path, e))
+                    continue
+                try:
+                    with open(hidden, 'rb') as infile:
+                        with open(coldfile + '.tmp', 'wb') as rawfile:
+                            with gzip.GzipFile(fileobj=rawfile, mode='wb') as outfile:
+                                shutil.copyfileobj(infile, outfile, 1024 * 1024)
+                            rawfile.flush()
+                            os.fsync(rawfile.fileno())
+                    os.utime(coldfile + '.tmp', (mtime, mtime))
+                    os.rename(coldfile + '.tmp', coldfile)
+                    os.remove(hidden)
+                except (IOError, OSError) as e:
+                    logger.warning('"{}" not moved to the cold spool.\n\tException Message: {}'.format(path, e))
+                    removefile(coldfile + '.tmp')
+                    if os.path.exists(hidden):
+                        removefile(coldfile)
+                        os.rename(hidden, path)
+                    continue
+
+                moved += 1
+                spool -= size
+                free = min(diskfree(TEMPDIR), diskfree(OUTPUTDIR))
+
+        if moved:
+            logger.info('Moved {} waiting upload(s) to the cold spool "{}"'.format(moved, COLDSPOOL))
+
+        return moved
+
+    def restore(self):
+        '''
+        Put files from COLDSPOOL back into OUTPUTDIR, oldest first, as long as
+         transfers would not have to be deferred afterwards
+        A file is not put back while a file of the same name is waiting or
+         being uploaded
+        Runs on the POSTWORKERS pool
+        '''
+
+        if not self.lock.acquire(False):
+            return # Already moving files
+        try:
+            busy = uploaderbusy()
+            for mtime, coldfile, coldsize in sorted(spoolfiles(COLDSPOOL)):
+                if not coldfile.endswith('.gz'):
+                    continue
+                with open(coldfile, 'rb') as infile:
+                    infile.seek(-4, os.SEEK_END)
+                    size = struct.unpack('<I', infile.read(4))[0] # Size of the original (modulo 4 GB)
+
+                free, spool = self.usage()
+                if self.deferring or self.reason(free - size, spool + size, True) is not None:
+                    break
+
+                outputfile = os.path.join(OUTPUTDIR, os.path.relpath(coldfile, COLDSPOOL))[:-3]
+                if os.path.exists(outputfile) or os.path.realpath(outputfile) in busy:
+                    continue
+                # Dot files are skipped by the uploader until renamed
+                restoring = os.path.join(os.path.dirname(outputfile), '.' + os.path.basename(outputfile))
+                folderinit(os.path.dirname(outputfile), 'Output Folder/Subfolder')
+                with gzip.open(coldfile, 'rb') as infile:
+                    with open(restoring, 'wb') as outfile:
+                        shutil.copyfileobj(infile, outfile, 1024 * 1024)
+                os.utime(restoring, (mtime, mtime))
+                os.rename(restoring, outputfile)
+                chown(outputfile)
+                os.remove(coldfile)
+                logger.info('Restored "{}" from the cold spool'.format(outputfile))
+                notifyuploader('published', outputfile)
+        except Exception as e:
+            logger.critical('Exception restoring files from the cold spool.\n\tException Message: {}'.format(e))
+        finally:
+            self.lock.release()
+
+        return
+
+def uploaderbusy():
+    '''
+    Files the uploader is working on (claimed, or uploaded and not yet
+     deleted) according to its queue UPLOADERQUEUE
+    Best effort - an empty set if the queue cannot be read
+    '''
+
+    if not os.path.exists(UPLOADERQUEUE):
+        return set()
+
+    try:
+        db = sqlite3.connect(UPLOADERQUEUE, timeout=5)
+        try:
+            rows = db.execute("SELECT fullname FROM files WHERE claimed != 0 OR state IN ('uploading', 'uploaded', 'notified')").fetchall()
+        finally:
+            db.close()
+    except sqlite3.Error as e:
+        logger.warning('Upload queue "{}" could not be read.\n\tException Message: {}'.format(UPLOADERQUEUE, e))
+        return set()
+
+    return set(os.path.realpath(row[0]) for row in rows)
+
+def deferwhilefull(connection, capacity):
+    '''
+    Hold off new transfers while [capacity] says the disk is too full
+    DTR is held high with RTS low, which the server reads as "not ready":
+     it waits instead of timing out and failing its files.  A HELLO from a
+     restarted server is still answered.
+    The reason is reported to the uploader (which posts it to Slack) on
+     every check, so an uploader started meanwhile learns it too.
+    '''
+
+    reason = capacity.check()
+    if reason is None:
+        return
+
+    logger.warning('Deferring transfers - {}'.format(reason))
+    started = time.time()
+    while reason is not None:
+        notifyuploader('deferring', OUTPUTDIR, reason=reason)
+        connection.setDTR(1)
+        if waitformessage(connection, CAPACITYINTERVAL):
+            incomingdata = connection.read(connection.inWaiting())
+            if HELLOSTRING in incomingdata:
+                connection.setDTR(0)
+                negotiate(connection, incomingdata)
+        reason = capacity.check()
+
+    connection.setDTR(0)
+    logger.info('Accepting transfers again after deferring them for {} seconds'.format(int(time.time() - started)))
+    notifyuploader('accepting', OUTPUTDIR)
+
+    return
+
 def logtouploader(filename):
     '''
     Moves the file to the Log Output folder
@@ -341,11 +1268,30 @@ def logtouploader(filename):
     try:
         shutil.copy2(filename, outputfile)
         chown(filename)
+        notifyuploader('published', outputfile)
     except Exception as e:
         logger.warning('Log file "{}" could not be copied to upload folder.\n\tException Message: {}'.format(filename, e))
     
     return
 
+def notifyuploader(event, path, **details):
+    '''
+    Report a file event to the file uploader so it can start uploading immediately
+    Best effort only - if the uploader is not listening the file is still
+     picked up by the uploader's periodic scan of OUTPUTDIR
+    '''
+
+    message = dict(details, event=event, path=path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.sendto(json.dumps(message).encode(), UPLOADERSOCKET)
+    except socket.error as e:
+        logger.debug('Uploader not notified of {} "{}" ({})'.format(event, path, e))
+    finally:
+        sock.close()
+
+    return
+
 def getpid():
     '''
     Used to help prevent more than one instance of the program from running
@@ -465,6 +1411,14 @@ def main():
     folderinit(TEMPDIR, 'TEMPDIR')
 
     ser = openserialport()
+    session = loadjournal(SESSIONFILE) or {}
+    ser = ChannelLink(ser, MULTIPLEX and session.get('mux', True))
+    ser.start()
+
+    pool = ThreadPool(POSTWORKERS)
+    processing = {} # Received file -> its post-receive work
+    capacity = Capacity()
+    spec = hashspec('md5', None) # Files are hashed while received, as the server hashed the last one
 
     while True:
 
@@ -483,54 +1437,104 @@ def main():
             totalbytes = 0
 
             initRTSDTR(ser)
+            deferwhilefull(ser, capacity)
+            if COLDSPOOL:
+                pool.apply_async(capacity.restore)
             logger.info('-'*30 + ' Waiting for file ' + '-'*30)
 
-            result = checkforstring(ser, INITSTRING, 5)
+            result = checkforstring(ser, INITSTRING)
             ser.setRTS(1)
 
-            result = checkforstring(ser, FILESTRING, 1)    
+            result = checkforstring(ser, FILESTRING)    
             ser.setRTS(0)
 
-            filename, subfolder = checkforfilename(ser)
+            filename, subfolder, meta = checkforfilename(ser)
+
+            # A file of the same name must be published before it is received again
+            partfile = os.path.normpath(os.path.join(TEMPDIR, filename))
+            if partfile in processing:
+                processing.pop(partfile).wait()
+            processing = dict((name, work) for name, work in processing.items() if not work.ready())
+
+            # A segment of a large file is kept in the segment store until the file is complete
+            segment = 'segs' in meta
+            received = filename
+            if segment:
+                received = '{}.seg{}'.format(filename, int(meta['seg']))
+                logger.info('Receiving segment {} of {} of "{}"'.format(int(meta['seg']) + 1, meta['segs'], filename))
+
+            offset = 0
+            journal = None
+            if RESUME and meta and not segment:
+                offset = resumeoffset(partfile, meta)
+                journal = {'size': meta.get('size'), 'id': meta.get('id')}
+                if offset:
+                    logger.info('Resuming "{}" at {:,} Bytes'.format(filename, offset))
 
             starttime = datetime.datetime.now()
-            ser.setRTS(1) # Tell server to start sending
+            ser.setDTR(1 if offset else 0) # Tell server whether the offset it offered is accepted
+            ser.setRTS(1) # Tell server to start sending (DTR is cleared by recvfile once data arrives)
             logger.info('Received InitString ({}), FileString ({}), and Filename received\n\tFile ({}) requested @ {}'.format(INITSTRING, FILESTRING, filename, str(starttime)))
 
-            chunkcount, totalbytes = recvfile(ser, filename, starttime)
+            hasher = newfilehash(spec)
+            chunkcount, totalbytes = recvfile(ser, received, starttime, hasher, offset, journal, segment)
             logger.info('File received: {:,} Bytes (in {:,} Chunks)'.format(totalbytes, chunkcount))
 
             endtime = datetime.datetime.now()
 
-            ser.setRTS(1) # Tell server to resume sending
-            result = checkforstring(ser, ENDSTRING, 1)
+            ser.setRTS(0) # Server waits for RTS after sending EndString
+            ser.setDTR(0)
+            result = checkforstring(ser, ENDSTRING)
             logger.debug('Server indicated transmission complete via EndString ({}) @ ({})\n'.format(ENDSTRING, datetime.datetime.now()))
             ser.setRTS(1) # Tell server to resume sending
 
-            remotehash = getremotehash(ser)
+            algorithm, remotehash = getremotehash(ser)
 
             ser.setRTS(0) # Turn off RTS
             ser.setDTR(1) # Turn on to indicate hash check started
 
-            filename = os.path.normpath(os.path.join(TEMPDIR, filename))    
-            hashvalue = filehash(filename)
-
-            if hashvalue != remotehash:
-                logger.warning('Transfer Failure - Hash Mismatch!!\n\tLocal File Hash \t= {}\n\tRemote File Hash\t= {}'.format(hashvalue, remotehash))
+            filename = partfile
+            received = os.path.normpath(os.path.join(TEMPDIR, received))
+            removefile(received + JOURNALSUFFIX) # Received - a failed file is sent again from the start
+            try:
+                if hashspec(algorithm, remotehash) == spec:
+                    hashvalue = hasher.hexdigest()
+                elif algorithm == 'merkle':
+                    # Build the same tree as the sender
+                    leafalgorithm, leafsize = remotehash.split(':')[:2]
+                    hashvalue = filehash(received, algorithm, leafalgorithm, int(leafsize))
+                    spec = hashspec(algorithm, remotehash)
+                else:
+                    hashvalue = filehash(received, algorithm)
+                    spec = hashspec(algorithm, remotehash)
+            except ValueError as e:
+                logger.critical('File cannot be verified. {}'.format(e))
+                hashvalue = None
+
+            transfersuccess = hashvalue == remotehash
+            if not transfersuccess:
+                logger.warning('Transfer Failure - Hash Mismatch!!\n\tLocal File Hash \t= {}\n\tRemote File Hash\t= {} ({})'.format(hashvalue, remotehash[:120], algorithm))
+                if algorithm == 'merkle' and hashvalue is not None:
+                    for start, end in damagedranges(hashvalue, remotehash):
+                        logger.warning('\tDamaged range: bytes {:,} - {:,}'.format(start, end))
                 ser.setRTS(0) # Turn off to indicate failure
                 ser.setDTR(0) # Turn off to indicate hash check done
-                tempfilecleanup(False, filename, subfolder)
             else:
-                logger.info('Transfer Success - Hashes Match (File Hash = {})'.format(hashvalue))
+                logger.info('Transfer Success - Hashes Match (File Hash = {} {})'.format(algorithm, hashvalue[:120]))
                 ser.setRTS(1) # Turn on to indicate success
                 ser.setDTR(0) # Turn off to indicate hash check done
-                tempfilecleanup(True, filename, subfolder)
+
+            if not segment:
+                processing[filename] = pool.apply_async(postreceive, (transfersuccess, filename, subfolder))
+            elif not transfersuccess:
+                removefile(received) # The server sends the segment again
+            elif storesegment(filename, meta):
+                processing[filename] = pool.apply_async(assemblesegments, (filename, int(meta['segs']), int(meta['size']), subfolder))
 
             transferspeed = (totalbytes / 1024) / (endtime - starttime).total_seconds()
             logger.info('Transfer finished @ {}\tElapsed Time: {} ({} KB/s)'.format(str(endtime), str(endtime - starttime), round(transferspeed, 1)))
             logger.info('-'*30 + ' End of transfer ' + '-'*30)
-            logtouploader(LOGFILENAME)
-            time.sleep(5)
+            time.sleep(RESULTHOLD)
 
         except KeyboardInterrupt as e:
             logger.warning('Keyboard Interrupt. Exiting program...\n\tException Message: {}'.format(e))        
@@ -539,5 +1543,8 @@ def main():
         except Exception as e:
             logger.critical('Exception in main loop. Restarting...\n\tException Message: {}'.format(e))        
 
+    pool.close()
+    pool.join()
+
 if __name__ == '__main__':
     main()
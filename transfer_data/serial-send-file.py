@@ -9,9 +9,20 @@ import os
 import logging
 from logging.handlers import RotatingFileHandler
 import platform
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 import shutil
 import signal
 import atexit
+import collections
+import json
+import struct
+import threading
+import zlib
+import errno
+from multiprocessing.pool import ThreadPool
 
 logger = logging.getLogger(__name__)
 LOGFILEDIR = '/var/lib/sierra'
@@ -22,6 +33,11 @@ FILESTRING = '<<FILE>>'.encode()
 ENDFNAMESTRING = '<<ENDFNAME>>'.encode()
 ENDSTRING = '<<DONE>>'.encode()
 SERVERALIVESTRING = 'Server Alive\n'.encode()
+HASHSTRING = '<<HASH>>'.encode()
+ENDHASHSTRING = '<<ENDHASH>>'.encode()
+HELLOSTRING = '<<HELLO>>'.encode()
+ENDHELLOSTRING = '<<ENDHELLO>>'.encode()
+METASTRING = '<<META>>'.encode()
 
 ROOT = '/tmp/server/uploads/'
 SRCDIR = os.path.normpath(os.path.normpath(os.path.join(ROOT, 'incoming/')))
@@ -29,12 +45,82 @@ FAILDIR = os.path.normpath(os.path.join(ROOT, 'failed/'))
 DONEDIR = os.path.normpath(os.path.join(ROOT, 'transferred/'))
 CACHEDIR = '/opt/sierra/serial_send_files/'
 IGNOREDFILES = ['Thumbs.db']
+SCANINTERVAL = 15 # Seconds between scans of each feed's srcdir for new files
+HANDSHAKEPOLL = 0.01 # Seconds between checks of CTS/DSR while waiting for the client
+DEFERPOLL = 1 # Seconds between checks while the client defers transfers (its disk is nearly full)
+PREFETCHFILES = 2 # Files of each feed staged in CACHEDIR ahead of the one being transmitted
+COPYBLOCKSIZE = 1024 * 1024 # Read size when staging files from the (network) source folder
+BOOKKEEPINTERVAL = 5 # Seconds sent files are collected before they are moved out of SRCDIR together
+BOOKKEEPBATCH = 200 # Most sent files moved in one batch
+SENTMANIFEST = '' # Record sent files in this (local) file instead of moving them to DONEDIR/FAILDIR ('' = move them)
+MANIFESTLOCK = threading.Lock() # Held while a feed's Bookkeeper appends to SENTMANIFEST
+
+# Source feeds - each is scanned and staged by its own threads, so a stalled mount only holds up its own files
+#  srcdir/donedir/faildir: as SRCDIR/DONEDIR/FAILDIR, prefix: subfolder its files are published under on the receiver,
+#  share: its share of the line while other feeds have files waiting too, quota: Bytes it may send per day (0 = no limit)
+FEEDS = [
+    {'name': 'uploads', 'srcdir': SRCDIR, 'donedir': DONEDIR, 'faildir': FAILDIR, 'prefix': '', 'share': 1, 'quota': 0},
+#    {'name': 'historian', 'srcdir': '/mnt/historian/export', 'donedir': '/mnt/historian/sent', 'faildir': '/mnt/historian/failed',
+#     'prefix': 'historian', 'share': 1, 'quota': 2 * 1024 * 1024 * 1024},
+]
 
 BAUD = 921600
 
+# Capability negotiation - at startup the features below are offered to the receiver in a
+#  HELLO and only those it accepts are used.  A receiver that does not answer (older
+#  versions) gets the legacy protocol.  False uses the settings below as they are.
+NEGOTIATE = True
+HELLOTIMEOUT = 5 # Seconds to wait for the receiver to start answering a HELLO
+HELLORETRIES = 3
+BITTIME = 0.05 # Seconds the receiver holds each half of an answer bit
+PROTOCOLVERSION = 1 # Framing version
+HASHPREFERENCE = ['blake2b', 'blake2s', 'md5'] # Fastest first - offered after HASHALGORITHM
+SESSION = {'hello': False, 'mux': False, 'zlib': False, 'resume': False, 'segments': False, 'hash': 'md5'} # In use (set by negotiate)
+
+# Preferred file hash: md5 (understood by all receivers), blake2b, blake2s
+#  (Python 3.6+, much faster than md5 on ARM), crc32 or merkle (tree of blake2b/md5 leaves)
+HASHALGORITHM = 'blake2b'
+HASHWORKERS = 4 # Threads hashing Merkle tree leaves
+MERKLELEAFSIZE = 1024 * 1024
+
+# Resume interrupted transfers (offered to the receiver - the file name carries a META block)
+RESUME = False
+RESUMEBLOCK = 256 * 1024 # Bytes sent between journal updates
+RESUMEMARGIN = 1536 * 1024 # Bytes sent that may not have reached the receiver's disk (its MULTIPLEX buffer is 1 MB)
+TRANSFERJOURNAL = os.path.join(LOGFILEDIR, 'transfer-journal.json')
+
+# Files larger than SEGMENTSIZE are sent a segment at a time, with other files sent
+#  between their segments (0 = off; offered to the receiver)
+SEGMENTSIZE = 0
+SEGMENTRETRIES = 3 # Failed attempts at one segment before the whole file fails
+SEGMENTEDFILES = 2 # Large files taking turns at once (each keeps its CACHEDIR copy until done) - others are sent whole
+SEGMENTJOURNAL = os.path.join(LOGFILEDIR, 'segment-journal.json')
+
+# Channel multiplexing (offered to the receiver)
+MULTIPLEX = False
+MUXMAGIC = b'\xa5\x5a' # Start of every frame
+MUXHEADER = struct.Struct('>2sBH') # Magic, channel, payload length - followed by payload and CRC32
+MUXFRAMESIZE = 1536 # Largest frame payload
+CONTROLCHANNEL = 0 # Handshakes, file names and hashes
+HEARTBEATCHANNEL = 1 # Heartbeats, telemetry and status messages
+DATACHANNEL = 2 # File contents
+LOGCHANNEL = 3 # Low priority log lines
+CHANNELSHARES = {LOGCHANNEL: 0.05} # Most of the line a channel may use while file data is being sent
+HEARTBEATINTERVAL = 5 # Seconds between heartbeats
+
+# Log shipping (MULTIPLEX only) - new lines of these logs are sent on the log channel
+LOGSOURCES = {'serial-send': LOGFILENAME} # Source name (names the log on the receiving side) -> log file
+LOGSHIPSTATE = os.path.join(LOGFILEDIR, 'logship-state.json')
+LOGSHIPINTERVAL = 10 # Seconds between checks for new log lines
+LOGBATCHSIZE = 4096 # Log bytes read per batch - cut down to whole lines that fit one MUXFRAMESIZE frame
+
 class InvalidMsgError(Exception):
     pass
 
+# A file copied to CACHEDIR and hashed, ready to be transmitted
+StagedFile = collections.namedtuple('StagedFile', 'feed root folder filename source cache hashvalue')
+PENDINGMESSAGES = queue.Queue() # Messages from other threads, sent by the transmitter between files (see queuemessage)
+
 def configure_logging():
     logger.setLevel(logging.DEBUG)
     logger.setLevel(logging.INFO)
@@ -55,28 +141,172 @@ def configure_logging():
         logger.critical('Error accessing log file{}.  Exiting.\n\tException Message: {}'.format(LOGFILENAME, e))
         sys.exit()
 
-def filehash(filepath):
+class CRC32Hash(object):
+    '''
+    hashlib style wrapper around zlib.crc32
+    Very fast, for catching transmission errors in blocks (not tamper-proof)
+    '''
+
+    name = 'crc32'
+
+    def __init__(self, data=b''):
+        self.crc = 0
+        self.update(data)
+
+    def update(self, data):
+        self.crc = zlib.crc32(data, self.crc) & 0xffffffff
+
+    def hexdigest(self):
+        return '{:08x}'.format(self.crc)
+
+class MerkleHash(object):
+    '''
+    Tree hash - the file is split into [leafsize] leaves that are hashed
+     separately, so large files can be hashed on several cores and a damaged
+     range can be located, and the root is the hash of the leaf digests
+    hexdigest() returns "leafalgorithm:leafsize:root:leaf,leaf,..."
+    '''
+
+    name = 'merkle'
+
+    def __init__(self, leafalgorithm=None, leafsize=MERKLELEAFSIZE):
+        self.leafalgorithm = leafalgorithm or ('blake2b' if 'blake2b' in HASHES else 'md5')
+        self.leafsize = leafsize
+        self.leaves = []
+        self.leaf = newhash(self.leafalgorithm)
+        self.leafbytes = 0
+
+    def update(self, data):
+        pos = 0
+        while pos < len(data):
+            take = min(len(data) - pos, self.leafsize - self.leafbytes)
+            self.leaf.update(data[pos:pos + take])
+            self.leafbytes += take
+            pos += take
+            if self.leafbytes == self.leafsize:
+                self.leaves.append(self.leaf.hexdigest())
+                self.leaf = newhash(self.leafalgorithm)
+                self.leafbytes = 0
+
+    def hexdigest(self):
+        leaves = list(self.leaves)
+        if self.leafbytes or not leaves:
+            leaves.append(self.leaf.hexdigest())
+        root = newhash(self.leafalgorithm)
+        root.update(','.join(leaves).encode())
+        return '{}:{}:{}:{}'.format(self.leafalgorithm, self.leafsize, root.hexdigest(), ','.join(leaves))
+
+HASHES = {'md5': hashlib.md5, 'crc32': CRC32Hash, 'merkle': MerkleHash}
+if hasattr(hashlib, 'blake2b'): # Python 3.6+
+    HASHES['blake2b'] = hashlib.blake2b
+    HASHES['blake2s'] = hashlib.blake2s
+
+def newhash(algorithm):
+    '''
+    Return a new hash object for [algorithm] (a key of HASHES)
+    Raises ValueError if the algorithm is not available on this system
+    '''
+
+    try:
+        return HASHES[algorithm]()
+    except KeyError:
+        raise ValueError('Hash algorithm "{}" is not available'.format(algorithm))
+
+def filehash(filepath, algorithm='md5', leafalgorithm=None, leafsize=MERKLELEAFSIZE):
     '''
-    Calculate and return the MD5 hash of the file
+    Calculate and return the hash of the file (hex digest)
+    Merkle tree leaves are hashed in parallel by HASHWORKERS threads
     '''
 
     blocksize = 64*1024
 
-    md5 = hashlib.md5()
+    if algorithm == 'merkle':
+        tree = MerkleHash(leafalgorithm, leafsize)
+        offsets = range(0, os.path.getsize(filepath), tree.leafsize)
+        pool = ThreadPool(HASHWORKERS)
+        try:
+            tree.leaves = pool.map(lambda offset: leafhash(filepath, offset, tree.leafsize, tree.leafalgorithm), offsets)
+        finally:
+            pool.close()
+            pool.join()
+        return tree.hexdigest()
+
+    hasher = newhash(algorithm)
     with open(filepath, 'rb') as fp:
         while True:
             data = fp.read(blocksize)
             if not data:
                 break
 
-            md5.update(data)
-    return md5.hexdigest()
+            hasher.update(data)
+    return hasher.hexdigest()
+
+def leafhash(filepath, offset, leafsize, algorithm):
+    '''
+    Hash one Merkle tree leaf ([leafsize] bytes from [offset]) of the file
+    '''
+
+    hasher = newhash(algorithm)
+    with open(filepath, 'rb') as fp:
+        fp.seek(offset)
+        hasher.update(fp.read(leafsize))
+    return hasher.hexdigest()
+
+def hashheader(filepath):
+    '''
+    Hash the file with HASHALGORITHM and return the hash as sent to the receiver
+    MD5 is sent as the bare 32 character digest every receiver understands;
+     other algorithms are sent as HASHSTRING + "algorithm:digest" + ENDHASHSTRING
+     so the receiver knows how to check the file
+    '''
+
+    algorithm = hashalgorithm()
+    return encodehash(algorithm, filehash(filepath, algorithm))
+
+def hashalgorithm():
+    '''
+    Hash algorithm agreed with the receiver (see negotiate)
+    '''
+
+    return SESSION['hash']
+
+def rangehash(filepath, start, end):
+    '''
+    Hash bytes [start] to [end] of the file like hashheader() hashes a whole file
+    '''
+
+    algorithm = hashalgorithm()
+    hasher = newhash(algorithm)
+    with open(filepath, 'rb') as fp:
+        fp.seek(start)
+        while fp.tell() < end:
+            data = fp.read(min(COPYBLOCKSIZE, end - fp.tell()))
+            if not data:
+                break
+            hasher.update(data)
+    return encodehash(algorithm, hasher.hexdigest())
+
+def fileid(hashvalue):
+    '''
+    Short identity of a file version (CRC32 of its hash) for META blocks and journals
+    '''
+
+    return '{:08x}'.format(zlib.crc32(hashvalue) & 0xffffffff)
+
+def encodehash(algorithm, hashvalue):
+    if algorithm == 'md5':
+        return hashvalue.encode()
+
+    return HASHSTRING + '{}:{}'.format(algorithm, hashvalue).encode() + ENDHASHSTRING
 
-def sendfiledata(connection, filename, filesize):
+def sendfiledata(connection, filename, filesize, offset=0, journal=None):
     '''
     Sends the file via the serial connection and
      uses RTS/CTS for flow control (timeout if CTS not received)
     Checks for invalid strings in the message
+    Starts at [offset] when resuming or sending a segment and stops at
+     [filesize] (the end of the segment); with a [journal] entry the bytes
+     sent are recorded in TRANSFERJOURNAL every RESUMEBLOCK
     '''
 
     # Chunksize has a significant impact on CPU usage
@@ -85,7 +315,7 @@ def sendfiledata(connection, filename, filesize):
     # Going higher simply increases CPU usage with no transfer rate increase
     chunksize = 1536
     chunkcount = 0
-    totalbytes = 0
+    totalbytes = offset
     cts = 0
     lastcts = 0
     eofstring = b''+"<<EOF>>\n".encode()
@@ -94,6 +324,7 @@ def sendfiledata(connection, filename, filesize):
     ctstimeoutcount = 0
 
     with open(filename,"rb") as readfile:
+        readfile.seek(offset)
         while True:
 
             # Wait for CTS (Clear to Send) to go high
@@ -101,7 +332,7 @@ def sendfiledata(connection, filename, filesize):
 
             if cts == 1:
                 ctstimeoutcount = 0
-                chunk = readfile.read(chunksize)
+                chunk = readfile.read(min(chunksize, filesize - totalbytes))
                 totalbytes += len(chunk)
 
                 if chunk != b'':
@@ -110,7 +341,13 @@ def sendfiledata(connection, filename, filesize):
                         logger.info('{:,}. {:,} Bytes Transferred ({:d}%)'.format(chunkcount, totalbytes, int((totalbytes/filesize) * 100)))
 
                     isinvalidmsg(chunk)
-                    connection.write(chunk)
+                    if isinstance(connection, ChannelMux):
+                        connection.send(DATACHANNEL, chunk)
+                    else:
+                        connection.write(chunk)
+
+                    if journal is not None and totalbytes // RESUMEBLOCK != (totalbytes - len(chunk)) // RESUMEBLOCK:
+                        savejournal(TRANSFERJOURNAL, dict(journal, sent=totalbytes))
                 else:
                     time.sleep(2)
                     logger.info('End of file - writing EOF')
@@ -129,18 +366,400 @@ def sendfiledata(connection, filename, filesize):
 
     return chunkcount, totalbytes
 
+def savejournal(path, entry):
+    '''
+    Atomically replace the transfer journal at [path] so it survives a power loss
+    '''
+
+    with open(path + '.tmp', 'w') as f:
+        json.dump(entry, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(path + '.tmp', path)
+
+def loadjournal(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+def removefile(path):
+    '''
+    Delete [path] if it exists
+    '''
+
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def prefixcrc(path, offset):
+    '''
+    CRC32 (hex) of the first [offset] bytes of the file, or None if it is shorter
+    '''
+
+    crc = 0
+    with open(path, 'rb') as f:
+        while offset > 0:
+            data = f.read(min(offset, 1024 * 1024))
+            if not data:
+                return None
+            crc = zlib.crc32(data, crc)
+            offset -= len(data)
+    return '{:08x}'.format(crc & 0xffffffff)
+
+def resumeoffer(journal, path):
+    '''
+    Offset the receiver is offered to resume an interrupted transfer of the
+     file in [journal] from, and the CRC32 of [path] up to it
+    (0, None) if TRANSFERJOURNAL is not for this file or too little was sent
+    '''
+
+    saved = loadjournal(TRANSFERJOURNAL)
+    if saved is None or any(saved.get(key) != value for key, value in journal.items()):
+        return 0, None
+
+    offset = (saved.get('sent', 0) - RESUMEMARGIN) // RESUMEBLOCK * RESUMEBLOCK
+    if offset <= 0:
+        return 0, None
+    return offset, prefixcrc(path, offset)
+
+def muxframe(channel, payload):
+    '''
+    Build one multiplexer frame
+    '''
+
+    frame = MUXHEADER.pack(MUXMAGIC, channel, len(payload)) + payload
+    return frame + struct.pack('>I', zlib.crc32(frame) & 0xffffffff)
+
+class ChannelMux(object):
+    '''
+    Carries several logical channels over the serial link (MULTIPLEX)
+    Everything written is sent as frames (see muxframe) tagged with its
+     channel.  Writers block until their frames are on the line, so each
+     channel stays in order; when several channels are waiting, the lowest
+     channel number goes first, so heartbeats and alerts get through during
+     a bulk transfer.  While file data is flowing, channels in CHANNELSHARES
+     (logs) are paced to their share of the line, otherwise they may use
+     all of it.
+    The write() of the serial port sends on the control channel, so the
+     transfer handshakes work unchanged.  Anything else (modem lines,
+     open/close) is passed to the serial port.
+    '''
+
+    def __init__(self, ser):
+        self.ser = ser
+        self.cond = threading.Condition()
+        self.busy = False
+        self.waiting = collections.Counter()
+        self.notbefore = collections.Counter() # Channel -> earliest time of its next frame
+        self.lastdata = 0
+
+    def __getattr__(self, name):
+        return getattr(self.ser, name)
+
+    def write(self, data):
+        self.send(CONTROLCHANNEL, data)
+
+    def send(self, channel, data):
+        for pos in range(0, max(len(data), 1), MUXFRAMESIZE):
+            payload = data[pos:pos + MUXFRAMESIZE]
+            self.acquire(channel)
+            try:
+                self.ser.write(muxframe(channel, payload))
+            finally:
+                self.release(channel, MUXHEADER.size + len(payload) + 4)
+
+    def nextchannel(self, now):
+        for channel in sorted(self.waiting):
+            if self.waiting[channel] and self.notbefore[channel] <= now:
+                return channel
+        return None
+
+    def acquire(self, channel):
+        with self.cond:
+            self.waiting[channel] += 1
+            try:
+                while True:
+                    now = time.time()
+                    if not self.busy and self.nextchannel(now) == channel:
+                        break
+                    delay = self.notbefore[channel] - now
+                    self.cond.wait(delay if delay > 0 else None)
+            finally:
+                self.waiting[channel] -= 1
+            self.busy = True
+
+    def release(self, channel, nbytes):
+        with self.cond:
+            now = time.time()
+            if channel == DATACHANNEL:
+                self.lastdata = now
+            share = CHANNELSHARES.get(channel)
+            if share and now - self.lastdata < 1:
+                self.notbefore[channel] = now + nbytes / (share * BAUD / 10)
+            self.busy = False
+            self.cond.notify_all()
+
+class Heartbeat(threading.Thread):
+    '''
+    Sends a heartbeat with sender telemetry on the heartbeat channel every
+     HEARTBEATINTERVAL seconds, including during transfers (MULTIPLEX only)
+    [status] is called for the telemetry to include
+    '''
+
+    def __init__(self, mux, status):
+        super(Heartbeat, self).__init__()
+        self.daemon = True
+        self.mux = mux
+        self.status = status
+
+    def run(self):
+        while True:
+            try:
+                self.mux.send(HEARTBEATCHANNEL, json.dumps(self.status()).encode())
+            except Exception as e:
+                logger.warning('Heartbeat not sent.\n\tException Message: {}'.format(e))
+            time.sleep(HEARTBEATINTERVAL)
+
+def logframe(source, lines):
+    '''
+    Log channel payload: "z" (zlib compressed) or "r" (raw), the source
+     name, a NUL and the log lines
+    '''
+
+    compressed = zlib.compress(lines)
+    if SESSION['zlib'] and len(compressed) < len(lines):
+        return b'z' + source.encode() + b'\0' + compressed
+    return b'r' + source.encode() + b'\0' + lines
+
+class LogShipper(threading.Thread):
+    '''
+    Tails the daemons' log files (LOGSOURCES) and sends only the new lines,
+     compressed, on the low priority log channel (MULTIPLEX only) instead of
+     sending whole log files through the diode
+    The position in each file is saved in LOGSHIPSTATE so a restart carries
+     on where it stopped.  When a log is rotated, the rest of the old file
+     (now .1) is sent before following the new one.
+    '''
+
+    def __init__(self, mux):
+        super(LogShipper, self).__init__()
+        self.daemon = True
+        self.mux = mux
+        try:
+            with open(LOGSHIPSTATE) as f:
+                self.positions = json.load(f)
+        except (IOError, ValueError):
+            self.positions = {}
+
+    def run(self):
+        while True:
+            for source, path in LOGSOURCES.items():
+                try:
+                    self.ship(source, path)
+                except Exception as e:
+                    logger.warning('Log "{}" not shipped.\n\tException Message: {}'.format(path, e))
+
+            try:
+                with open(LOGSHIPSTATE, 'w') as f:
+                    json.dump(self.positions, f)
+            except IOError as e:
+                logger.warning('Log shipping state not saved.\n\tException Message: {}'.format(e))
+
+            time.sleep(LOGSHIPINTERVAL)
+
+    def ship(self, source, path):
+        if not os.path.exists(path):
+            return
+
+        inode = os.stat(path).st_ino
+        if source not in self.positions:
+            # Only records written from now on
+            self.positions[source] = [inode, os.path.getsize(path)]
+            return
+
+        oldinode, position = self.positions[source]
+        if oldinode != inode:
+            rotated = path + '.1'
+            if os.path.exists(rotated) and os.stat(rotated).st_ino == oldinode:
+                self.send(source, rotated, position, None)
+            position = 0
+        elif os.path.getsize(path) < position:
+            position = 0 # Truncated
+
+        self.positions[source] = [inode, self.send(source, path, position, inode)]
+
+    def send(self, source, path, position, inode):
+        '''
+        Send the complete lines of [path] after [position] and return the new position
+        The receiver reads each frame as a whole batch, so a batch is cut to
+         fewer lines until it fits one frame (compressed if possible)
+        '''
+
+        with open(path, 'rb') as f:
+            f.seek(position)
+            while True:
+                data = f.read(LOGBATCHSIZE)
+                end = data.rfind(b'\n') + 1
+                if len(data) == LOGBATCHSIZE and not end:
+                    end = len(data) # Line longer than a batch, send it in pieces
+                if not end:
+                    return position
+                frame = logframe(source, data[:end])
+                while len(frame) > MUXFRAMESIZE:
+                    end = data.rfind(b'\n', 0, end // 2) + 1 or end // 2
+                    frame = logframe(source, data[:end])
+                self.mux.send(LOGCHANNEL, frame)
+                position += end
+                f.seek(position)
+                if inode is not None:
+                    self.positions[source] = [inode, position]
+
+def offer():
+    '''
+    Features offered to the receiver in the HELLO, in the order of its answer bits
+    '''
+
+    features = []
+    if MULTIPLEX:
+        features.append('mux')
+    features.append('zlib')
+    if RESUME:
+        features.append('resume')
+    if SEGMENTSIZE:
+        features.append('segments')
+    for algorithm in [HASHALGORITHM] + HASHPREFERENCE:
+        if algorithm in HASHES and 'hash:' + algorithm not in features:
+            features.append('hash:' + algorithm)
+    return features
+
+def negotiate(connection):
+    '''
+    Exchange capabilities with the receiver and set SESSION to the fastest
+     modes both ends support
+    The HELLO (version, frame size, offered features) is sent as plain text,
+     which older receivers ignore.  The answer is one bit per feature on the
+     modem lines (readbits); without one the legacy protocol is used.
+    '''
+
+    features = offer()
+    answered = False
+    if not NEGOTIATE:
+        accepted = features
+        if HASHALGORITHM in HASHES:
+            accepted = [feature for feature in features if not feature.startswith('hash:') or feature == 'hash:' + HASHALGORITHM]
+    else:
+        waitforclient(connection) # Its answer bits are clocked on DSR
+        hello = {'version': PROTOCOLVERSION, 'framesize': MUXFRAMESIZE, 'features': features, 'merkleleaf': MerkleHash().leafalgorithm}
+        for attempt in range(HELLORETRIES):
+            logger.info('Sending HELLO (attempt {} of {}): {}'.format(attempt + 1, HELLORETRIES, hello))
+            connection.write(HELLOSTRING + json.dumps(hello).encode() + ENDHELLOSTRING)
+            bits = readbits(connection, len(features), HELLOTIMEOUT)
+            if bits is not None:
+                accepted = [feature for feature, bit in zip(features, bits) if bit]
+                answered = True
+                break
+        else:
+            logger.warning('Receiver did not answer the HELLO. Using the legacy protocol.')
+            accepted = []
+
+    SESSION['hello'] = answered # Client acknowledges handshakes as soon as it has read them (waitforCTS)
+    SESSION['mux'] = 'mux' in accepted
+    SESSION['zlib'] = 'zlib' in accepted
+    SESSION['resume'] = 'resume' in accepted
+    SESSION['segments'] = 'segments' in accepted
+    SESSION['hash'] = 'md5'
+    for feature in accepted:
+        if feature.startswith('hash:'):
+            SESSION['hash'] = feature[5:]
+            break
+    logger.info('Session: {}'.format(SESSION))
+
+    return SESSION
+
+def readbits(connection, count, timeout):
+    '''
+    Read [count] bits the receiver clocks out on the modem lines: it sets
+     the bit on RTS (our CTS) and then toggles DTR (our DSR)
+    Returns the list of bits, or None if the receiver does not start
+     answering within [timeout] seconds
+    '''
+
+    bits = []
+    dsr = connection.getDSR()
+    deadline = time.time() + timeout
+    while len(bits) < count:
+        if time.time() > deadline:
+            if bits:
+                logger.warning('Receiver stopped answering after {} of {} bits'.format(len(bits), count))
+            return None
+        if connection.getDSR() != dsr:
+            dsr = not dsr
+            bits.append(bool(connection.getCTS()))
+            deadline = time.time() + BITTIME * 20
+        time.sleep(HANDSHAKEPOLL)
+
+    # The receiver drops both lines when it is done
+    deadline = time.time() + BITTIME * 20
+    while (connection.getCTS() or connection.getDSR()) and time.time() < deadline:
+        time.sleep(HANDSHAKEPOLL)
+
+    return bits
+
+def waitforclient(connection):
+    '''
+    Wait as long as the client defers transfers: it holds DSR high with CTS
+     low while its disk is nearly full (until its uploads catch up)
+    '''
+
+    if not connection.getDSR() or connection.getCTS():
+        return
+
+    logger.warning('Client is deferring transfers until its disk has room again. Waiting...')
+    started = time.time()
+    while connection.getDSR() and not connection.getCTS():
+        time.sleep(DEFERPOLL)
+    logger.info('Client accepting transfers again after {} seconds'.format(int(time.time() - started)))
+
+    return
+
 def waitforCTS(connection, writedata, retries, delay, message, endstate):
     '''
     Write the message [writedata] at least once and then until either CTS
      changes to [endstate] or the number of [retries] is exceeded.
      Retries sent every [delay] seconds and [message] printed each retry
+    CTS is polled only if the client answered the HELLO (SESSION['hello']).
+     A legacy client raises RTS before it reads the EndString, so CTS is
+     checked once each [delay] has passed, as that client expects.
+    While waiting for CTS high, time the client spends deferring transfers
+     (waitforclient) does not count as a retry
     '''
     count = 0
 
     while True:
+        if endstate:
+            waitforclient(connection)
         connection.write(writedata)
         count += 1
-        time.sleep(delay)
+        deferred = False
+        deadline = time.time() + delay
+        if not SESSION['hello']:
+            time.sleep(delay)
+        while True:
+            if connection.getCTS() == endstate:
+                return True
+            if endstate and connection.getDSR():
+                deferred = True
+                break
+            if time.time() >= deadline:
+                break
+            time.sleep(HANDSHAKEPOLL)
+
+        if deferred:
+            count -= 1
+            continue
 
         logger.info(message + ' (attempt {} of {})'.format(count, retries))
         if count >= retries:
@@ -148,9 +767,6 @@ def waitforCTS(connection, writedata, retries, delay, message, endstate):
             raise Exception('CTS timeout after {} retries of {} seconds ({} seconds)'.format(count, delay, count * delay))
             return False
 
-        if connection.getCTS() == endstate:
-            return True
-
     return
 
 def getportname():
@@ -171,43 +787,75 @@ def getportname():
     else:
         return 0 # Interpreted by Pyserial as the first serial port
 
-def transferfile(ser, sourcefolder, subfolder, filename):
+def transferfile(ser, sourcefolder, subfolder, filename, hashvalue=None, segment=None):
     '''
     File Transfer Manager
     Handles various handshakes between sender/receiver and
      sending of file name and hash. Calls the function that
      actually sends the file contents
+    The hash (as returned by hashheader) is calculated here unless given
+    With [segment] (index, count) only that SEGMENTSIZE segment of the file
+     is sent, checked by its own hash
     '''
 
     filesize = os.path.getsize(os.path.join(sourcefolder, filename))
-    hashvalue = filehash(os.path.join(sourcefolder, filename))
+    if hashvalue is None:
+        hashvalue = hashheader(os.path.join(sourcefolder, filename))
 
     ser.write(filename.encode() + b' ' +  str(filesize).encode() + '\n'.encode())
 
+    start, end = 0, filesize
+    offset = 0
+    journal = None
+    meta = b''
+    if segment is not None:
+        start = segment[0] * SEGMENTSIZE
+        end = min(start + SEGMENTSIZE, filesize)
+        meta = METASTRING + 'size={};id={};seg={};segs={}'.format(filesize, fileid(hashvalue), segment[0], segment[1]).encode()
+        hashvalue = rangehash(os.path.join(sourcefolder, filename), start, end)
+        logger.info('Sending segment {} of {} ({:,} - {:,} Bytes)'.format(segment[0] + 1, segment[1], start, end))
+    elif SESSION['resume']:
+        journal = {'name': os.path.join(subfolder, filename), 'size': str(filesize), 'id': fileid(hashvalue)}
+        offset, crc = resumeoffer(journal, os.path.join(sourcefolder, filename))
+        fields = 'size={};id={}'.format(journal['size'], journal['id'])
+        if offset:
+            fields += ';offset={};crc={}'.format(offset, crc)
+        meta = METASTRING + fields.encode()
+
     waitforCTS(ser, INITSTRING, 5, 6, 'Waiting for file request from client via CTS high, Sending InitString', True)
     waitforCTS(ser, FILESTRING, 5, 3, 'Waiting for filename confirmation from client via CTS low, Sending FileString', False)
 
-    ser.write(os.path.join(subfolder, filename).encode() + ENDFNAMESTRING) # Send filename to client
+    ser.write(os.path.join(subfolder, filename).encode() + meta + ENDFNAMESTRING) # Send filename to client
+
+    if offset:
+        # The client sets DTR before RTS if it accepts the offset and holds it until data arrives
+        deadline = time.time() + 20
+        while not ser.getCTS() and time.time() < deadline:
+            time.sleep(HANDSHAKEPOLL)
+        if ser.getDSR():
+            logger.info('Client accepted resuming "{}" at {:,} Bytes'.format(filename, offset))
+        else:
+            logger.info('Client did not accept resuming "{}" at {:,} Bytes. Sending the whole file.'.format(filename, offset))
+            offset = 0
 
     starttime = datetime.datetime.now()
     logger.info('File request received - Transferring "{}"'.format(filename))
 
-    chunkcount, totalbytes = sendfiledata(ser, os.path.join(sourcefolder, filename), filesize)
-    logger.info('Read {:,} Bytes (in {} chunks) of {:,} Bytes - {:,} Bytes missed'.format(totalbytes, chunkcount, filesize, filesize - totalbytes))
-    if filesize - totalbytes != 0:
-        logger.warning('Transfer file size mismatch ({:,} Bytes) - Transferred {:,} Bytes\tFile Size {:,} Bytes'.format(filesize - totalbytes, totalbytes, filesize))
+    chunkcount, totalbytes = sendfiledata(ser, os.path.join(sourcefolder, filename), end, start + offset, journal)
+    logger.info('Read {:,} Bytes (in {} chunks) of {:,} Bytes - {:,} Bytes missed'.format(totalbytes, chunkcount, end, end - totalbytes))
+    if end - totalbytes != 0:
+        logger.warning('Transfer file size mismatch ({:,} Bytes) - Transferred {:,} Bytes\tFile Size {:,} Bytes'.format(end - totalbytes, totalbytes, end))
     time.sleep(1)
 
     waitforCTS(ser, ENDSTRING, 5, 2, 'Sending EndString until CTS high', True)
 
-    ser.write(hashvalue.encode())
-    logger.info('Sending hash: {}'.format(hashvalue.encode()))
+    ser.write(hashvalue)
+    logger.info('Sending hash: {}'.format(hashvalue[:120]))
 
-    while True:
-        logger.info('Waiting for confirmation from client of successful transfer via DSR low')
-        time.sleep(0.5)
-        if ser.getDSR() == False:
-            break
+    logger.info('Waiting for confirmation from client of successful transfer via DSR low')
+    time.sleep(0.5)
+    while ser.getDSR():
+        time.sleep(HANDSHAKEPOLL)
 
     if ser.getCTS() == True:
         transferstatus = 1
@@ -216,6 +864,15 @@ def transferfile(ser, sourcefolder, subfolder, filename):
         transferstatus = 0
         logger.critical('!!CTS low - client indicated file corrupted!! ({}, {})'.format(ser.getCTS(), ser.getDSR()))
 
+    # Finished either way - a failed file is sent again from the start
+    if journal is not None:
+        removefile(TRANSFERJOURNAL)
+
+    # The client drops RTS once it is waiting for the next file
+    deadline = time.time() + 10
+    while ser.getCTS() and time.time() < deadline:
+        time.sleep(HANDSHAKEPOLL)
+
     endtime = datetime.datetime.now()
     logger.debug('\nSent {:,} Chunks'.format(chunkcount))
     logger.info('Finished @ ' + str(endtime) + '\tElapsed Time: %s ' % (str(endtime - starttime)))
@@ -224,15 +881,384 @@ def transferfile(ser, sourcefolder, subfolder, filename):
     return transferstatus #ser.getCTS()
 
 def cachefile(src, dst, filename):
+    '''
+    Copy the file to the local cache folder with large sequential reads
+     (the source is usually a network mount) and hash it on the way
+    Returns the hash as sent to the receiver (see hashheader)
+    '''
 
     folderinit(dst, 'Cache folder')
 
+    algorithm = hashalgorithm()
+    hasher = newhash(algorithm)
     try:
         logger.info('Caching file locally: Copying "{}" to "{}"'.format(os.path.join(src, filename), os.path.join(dst, filename)))
-        shutil.copy2(os.path.join(src, filename), os.path.join(dst, filename))
+        with open(os.path.join(src, filename), 'rb') as infile, open(os.path.join(dst, filename), 'wb') as outfile:
+            while True:
+                data = infile.read(COPYBLOCKSIZE)
+                if not data:
+                    break
+                hasher.update(data)
+                outfile.write(data)
+        shutil.copystat(os.path.join(src, filename), os.path.join(dst, filename))
     except Exception as e:
         raise
 
+    return encodehash(algorithm, hasher.hexdigest())
+
+class Feed(object):
+    '''
+    A source of files to send (an entry of FEEDS), with its own queues and
+     its own Scanner, Stager and Bookkeeper threads
+    '''
+
+    def __init__(self, name, srcdir, donedir, faildir, prefix='', share=1, quota=0):
+        self.name = name
+        self.srcdir = os.path.normpath(srcdir)
+        self.donedir = os.path.normpath(donedir)
+        self.faildir = os.path.normpath(faildir)
+        self.prefix = prefix
+        self.share = share
+        self.quota = quota
+        self.cachedir = os.path.join(CACHEDIR, name)
+        self.tostage = queue.Queue()
+        self.staged = queue.Queue(maxsize=PREFETCHFILES)
+        self.inflight = set()
+        self.inflightlock = threading.Lock()
+        self.bookkeeper = Bookkeeper(self)
+        self.position = 0.0 # Bytes sent / share (see FeedScheduler)
+        self.day = None
+        self.senttoday = 0 # Bytes sent on [day]
+
+    def start(self, ser, arrived):
+        self.bookkeeper.start()
+        Scanner(ser, self).start()
+        Stager(self, arrived).start()
+
+    def overquota(self):
+        today = datetime.date.today()
+        if self.day != today:
+            self.day = today
+            self.senttoday = 0
+
+        return self.quota > 0 and self.senttoday >= self.quota
+
+class FeedScheduler(object):
+    '''
+    Chooses the feed whose staged file is sent next
+    Each feed's position advances by the Bytes it sends divided by its
+     share and the feed furthest behind goes next.  A feed that was idle
+     starts level with the feed sent last (clock), so it cannot make up for
+     line time it did not use.  A feed that sent its quota waits for the next day.
+    '''
+
+    def __init__(self, feeds):
+        self.feeds = feeds
+        self.clock = 0.0 # Position of the feed sent last
+        self.arrived = threading.Event() # Set by the stagers
+
+    def next(self, timeout=0):
+        '''
+        Take the next staged file, waiting up to [timeout] seconds for one
+        Returns None if no feed has a file ready
+        '''
+
+        deadline = time.time() + timeout
+        while True:
+            self.arrived.clear()
+            ready = [feed for feed in self.feeds if not feed.staged.empty() and not feed.overquota()]
+            if ready:
+                feed = min(ready, key=lambda feed: max(feed.position, self.clock))
+                self.clock = feed.position = max(feed.position, self.clock)
+                return feed.staged.get_nowait()
+
+            remaining = deadline - time.time()
+            if remaining <= 0 or not self.arrived.wait(remaining):
+                return None
+
+    def charge(self, feed, nbytes):
+        feed.position += nbytes / feed.share
+        feed.senttoday += nbytes
+
+class Scanner(threading.Thread):
+    '''
+    Finds files to send in the srcdir of [feed] every SCANINTERVAL seconds
+     and queues them for the feed's stager
+    Files already queued, staged or being sent are tracked in the feed's
+     inflight set and are not queued twice
+    '''
+
+    def __init__(self, ser, feed):
+        super(Scanner, self).__init__()
+        self.daemon = True
+        self.ser = ser
+        self.feed = feed
+        self.bookkeeper = feed.bookkeeper
+        self.tostage = feed.tostage
+        self.inflight = feed.inflight
+        self.inflightlock = feed.inflightlock
+        self.missing = False # Client already told the source folder is missing
+
+    def run(self):
+        while True:
+            try:
+                if os.path.exists(self.feed.srcdir):
+                    self.missing = False
+                    self.scan()
+                else:
+                    logger.warning('Source folder "{}" ({} feed) not found.  Shared folder may not be mounted.'.format(self.feed.srcdir, self.feed.name))
+                    if not self.missing:
+                        queuemessage(self.ser, 'Source folder "{}" ({} feed) not found.  Shared folder may not be mounted.'.format(self.feed.srcdir, self.feed.name))
+                        self.missing = True
+            except Exception as e:
+                logger.critical('Exception scanning for files.\n\tException Message: {}'.format(e))
+
+            time.sleep(SCANINTERVAL)
+
+    def scan(self):
+        logger.debug('-'*30 + ' Checking for files ' + '-'*30)
+
+        for root, dirs, files in os.walk(self.feed.srcdir):
+            files = removeignored(files, root)
+            if SENTMANIFEST:
+                files = [f for f in files if not self.bookkeeper.recorded(os.path.join(root, f))]
+            with self.inflightlock:
+                files = [f for f in files if os.path.join(root, f) not in self.inflight]
+                self.inflight.update(os.path.join(root, f) for f in files)
+            if files: logger.info('Queueing file(s) in "{}": {}.'.format(root, files))
+
+            for f in files:
+                folder = root.replace(self.feed.srcdir, '')
+                if len(folder) > 0:
+                    folder = folder[1::] # Strip off leading "/"
+                self.tostage.put((root, folder, f))
+
+class Stager(threading.Thread):
+    '''
+    Copies queued files to CACHEDIR (hashing them on the way) ahead of the
+     transmitter, so the serial line is not idle while the next file is read
+     from the network mount
+    At most PREFETCHFILES staged files of [feed] wait in its staged queue;
+     a stalled mount only stops its own feed once those have been sent.
+     [arrived] is set whenever a file is staged.
+    '''
+
+    def __init__(self, feed, arrived):
+        super(Stager, self).__init__()
+        self.daemon = True
+        self.feed = feed
+        self.arrived = arrived
+        self.tostage = feed.tostage
+        self.staged = feed.staged
+        self.inflight = feed.inflight
+        self.inflightlock = feed.inflightlock
+
+    def run(self):
+        while True:
+            root, folder, f = self.tostage.get()
+            source = os.path.join(root, f)
+            cache = os.path.normpath(os.path.join(self.feed.cachedir, folder))
+            filename = os.path.normpath(f)
+
+            try:
+                hashvalue = cachefile(root, cache, filename)
+            except Exception as e:
+                logger.error('File "{}" could not be staged. It will be retried on the next scan.\n\tException Message: {}'.format(source, e))
+                with self.inflightlock:
+                    self.inflight.discard(source)
+                continue
+
+            self.staged.put(StagedFile(self.feed, root, folder, filename, source, cache, hashvalue))
+            self.arrived.set()
+
+class Bookkeeper(threading.Thread):
+    '''
+    Moves sent files of [feed] out of its srcdir (to its donedir, or faildir
+     if they failed) in batches, off the transmitter's path - on the network
+     mount every check and move costs round-trips
+    Folders known to exist are remembered, and files are renamed within the
+     mount instead of copied and deleted.  With SENTMANIFEST set, sent files
+     are recorded there instead and left in srcdir (the Scanner skips them
+     unless they change).
+    Files stay in the feed's inflight set until they are moved, so they are
+     not queued again
+    '''
+
+    def __init__(self, feed):
+        super(Bookkeeper, self).__init__()
+        self.daemon = True
+        self.feed = feed
+        self.inflight = feed.inflight
+        self.inflightlock = feed.inflightlock
+        self.pending = queue.Queue()
+        self.lock = threading.Lock() # Held while a batch is applied
+        self.folders = set() # Destination folders known to exist
+        self.manifest = {} # Source path -> [size, mtime] of the files in SENTMANIFEST
+
+        if SENTMANIFEST and os.path.exists(SENTMANIFEST):
+            with open(SENTMANIFEST) as manifest:
+                for line in manifest:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue # Partly written when the program stopped
+                    if entry['path'].startswith(feed.srcdir):
+                        self.manifest[entry['path']] = [entry['size'], entry['mtime']]
+            logger.info('{} sent file(s) of the {} feed recorded in "{}"'.format(len(self.manifest), feed.name, SENTMANIFEST))
+
+    def add(self, source, folder, filename, success):
+        self.pending.put((source, folder, filename, success))
+
+    def recorded(self, path):
+        '''
+        True if [path] is in SENTMANIFEST and has not changed since it was sent
+        '''
+
+        entry = self.manifest.get(path)
+        if entry is None:
+            return False
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+
+        return entry == [stat.st_size, int(stat.st_mtime)]
+
+    def run(self):
+        while True:
+            batch = [self.pending.get()]
+            deadline = time.time() + BOOKKEEPINTERVAL
+            while len(batch) < BOOKKEEPBATCH:
+                try:
+                    batch.append(self.pending.get(timeout=max(deadline - time.time(), 0)))
+                except queue.Empty:
+                    break
+            self.apply(batch)
+
+    def flush(self):
+        '''
+        Apply everything still queued (at exit)
+        '''
+
+        batch = []
+        while True:
+            try:
+                batch.append(self.pending.get_nowait())
+            except queue.Empty:
+                break
+        self.apply(batch)
+
+    def apply(self, batch):
+        with self.lock:
+            try:
+                if SENTMANIFEST:
+                    self.record(batch)
+                else:
+                    for source, folder, filename, success in batch:
+                        self.move(source, os.path.join(self.feed.donedir if success else self.feed.faildir, folder), filename)
+            except Exception as e:
+                logger.critical('Exception moving sent files.\n\tException Message: {}'.format(e))
+            finally:
+                with self.inflightlock:
+                    for source, folder, filename, success in batch:
+                        self.inflight.discard(source)
+
+        return
+
+    def move(self, source, folder, filename):
+        destination = os.path.join(folder, filename)
+        logger.info('Moving file to "{}".'.format(destination))
+        if folder not in self.folders:
+            folderinit(folder, 'Transferred/Failed subfolder')
+            self.folders.add(folder)
+
+        try:
+            os.rename(source, destination)
+        except OSError as e:
+            if e.errno == errno.ENOENT and not os.path.isdir(folder):
+                self.folders.discard(folder) # Removed behind our back - created again next time
+                logger.warning("Unable to move file '{}' to '{}'.\n\tException Message: {}".format(source, destination, e))
+            elif e.errno == errno.EXDEV:
+                shutil.move(source, destination) # donedir/faildir on another mount
+            else:
+                logger.warning("Unable to move file '{}' to '{}'.\n\tException Message: {}".format(source, destination, e))
+
+    def record(self, batch):
+        lines = []
+        for source, folder, filename, success in batch:
+            try:
+                stat = os.stat(source)
+            except OSError as e:
+                logger.warning("Sent file '{}' not recorded.\n\tException Message: {}".format(source, e))
+                continue
+            entry = {'path': source, 'size': stat.st_size, 'mtime': int(stat.st_mtime), 'sent': bool(success)}
+            lines.append(json.dumps(entry) + '\n')
+            self.manifest[source] = [entry['size'], entry['mtime']]
+
+        with MANIFESTLOCK:
+            with open(SENTMANIFEST, 'a') as manifest:
+                manifest.writelines(lines)
+                manifest.flush()
+                os.fsync(manifest.fileno())
+        logger.info('Recorded {} sent file(s) in "{}"'.format(len(lines), SENTMANIFEST))
+
+class SegmentedFile(object):
+    '''
+    A staged file larger than SEGMENTSIZE, sent one segment at a time so
+     other files can be sent between its segments
+    Segments the client confirmed are recorded in SEGMENTJOURNAL, so after a
+     restart only the missing ones are sent again.  A segment failing
+     SEGMENTRETRIES times fails the whole file.
+    '''
+
+    def __init__(self, item):
+        self.item = item
+        self.name = os.path.join(item.feed.prefix, item.folder, item.filename)
+        self.size = os.path.getsize(os.path.join(item.cache, item.filename))
+        self.count = (self.size + SEGMENTSIZE - 1) // SEGMENTSIZE
+        self.id = fileid(item.hashvalue)
+        self.failures = {}
+        self.failed = False
+
+        entry = (loadjournal(SEGMENTJOURNAL) or {}).get(self.name, {})
+        done = []
+        if entry.get('id') == self.id and entry.get('size') == self.size and entry.get('segsize') == SEGMENTSIZE:
+            done = entry.get('done', [])
+            logger.info('{} of {} segments of "{}" already sent'.format(len(done), self.count, self.name))
+        self.pending = [index for index in range(self.count) if index not in done]
+
+    def sent(self, index, result):
+        if result:
+            self.pending.remove(index)
+        else:
+            self.failures[index] = self.failures.get(index, 0) + 1
+            if self.failures[index] >= SEGMENTRETRIES:
+                logger.critical('Segment {} of "{}" failed {} times. Giving up on the file.'.format(index + 1, self.name, SEGMENTRETRIES))
+                self.failed = True
+
+        saved = loadjournal(SEGMENTJOURNAL) or {}
+        if self.finished():
+            saved.pop(self.name, None)
+        else:
+            saved[self.name] = {'id': self.id, 'size': self.size, 'segsize': SEGMENTSIZE,
+                                'done': [index for index in range(self.count) if index not in self.pending]}
+        savejournal(SEGMENTJOURNAL, saved)
+
+    def finished(self):
+        return self.failed or not self.pending
+
+def discardcached(item):
+    '''
+    Delete the CACHEDIR copy of the staged file [item]
+    '''
+
+    cached = os.path.join(item.cache, item.filename)
+    logger.info('Deleting cached file "{}".'.format(cached))
+    try:
+        os.remove(cached)
+    except OSError as e:
+        logger.warning('Cached file "{}" could not be deleted.\n\tException Message: {}'.format(cached, e))
+
 def isinvalidmsg(message):
     '''
     Checks if the provided message contains any of the reserved keywords
@@ -343,13 +1369,30 @@ def closeserialport(connection):
 def sendmessage(connection, message):
     '''
     Send the message to the specified serial connection
+    With MULTIPLEX it goes on the heartbeat channel, so it cannot get in the
+     way of a transfer
     '''
 
     try:
-        connection.write('SERVER UPDATE: {}'.format(message))
+        if isinstance(connection, ChannelMux):
+            connection.send(HEARTBEATCHANNEL, 'SERVER UPDATE: {}'.format(message).encode())
+        else:
+            connection.write('SERVER UPDATE: {}'.format(message))
     except Exception as e:
         logger.warning('Exception sending message "{}" to client.\n\tException Message: {}'.format(message, e))
 
+def queuemessage(connection, message):
+    '''
+    Send a message from a thread other than the transmitter
+    Without MULTIPLEX it would end up in the middle of a transfer, so it
+     waits in PENDINGMESSAGES until the transmitter is idle
+    '''
+
+    if isinstance(connection, ChannelMux):
+        sendmessage(connection, message)
+    else:
+        PENDINGMESSAGES.put(message)
+
 def uploadfile(srcfile, dstfolder):
     '''
     Copy a file to the upload folder
@@ -386,14 +1429,19 @@ def main():
     '''
     Transfer flow
 
+    Server --> Send HELLO with its capabilities (once, at startup)
+    Clocks out one bit per capability accepted on RTS (data) and DTR (clock) <-- Client
+
     Server --> Send InitString until CTS goes high
+    Holds DTR high (RTS low) instead while its disk is nearly full - the server waits <-- Client
     Sets RTS high when InitString received <-- Client
 
     Server --> Send FileString until CTS goes low
     Sets RTS low when InitString received <-- Client
 
-    Server --> Send filename
-    Sets RTS high when filename received <-- Client
+    Server --> Send filename (with RESUME or SEGMENTSIZE, followed by a META block
+      offering a resume offset or naming the segment sent)
+    Sets DTR high if the offset is accepted, then RTS high when filename received <-- Client
 
     Server --> Send file when CTS goes high
         Server <--> Client toggle CTS/RTS during transfer for flow control
@@ -431,13 +1479,29 @@ def main():
     folderinit(CACHEDIR, 'CACHEDIR')
 
     ser = openserialport()
+    negotiate(ser)
+    starttime = time.time()
+
+    # Scanner -> stager -> transmitter (this thread) pipeline per feed
+    #  Source folders are only touched by the feed's own threads (a missing one is reported by its Scanner)
+    feeds = [Feed(**feed) for feed in FEEDS]
+    scheduler = FeedScheduler(feeds)
+
+    transfercount['successful'] = 0
+    transfercount['failed'] = 0
+
+    if SESSION['mux']:
+        ser = ChannelMux(ser)
+        Heartbeat(ser, lambda: {'uptime': int(time.time() - starttime), 'successful': transfercount['successful'],
+                                'failed': transfercount['failed'], 'staged': sum(feed.staged.qsize() for feed in feeds),
+                                'queued': sum(feed.tostage.qsize() for feed in feeds)}).start()
+        LogShipper(ser).start()
+
+    for feed in feeds:
+        feed.start(ser, scheduler.arrived)
 
-    if os.path.isdir(ROOT) == False:
-        logger.warning('Root folder "{}" not found.  Shared folder may not be mounted.'.format(ROOT))
-        sendmessage(ser, 'Root folder "{}" not found.  Shared folder may not be mounted.'.format(ROOT))
-    elif os.path.isdir(SRCDIR) == False:
-        logger.warning('Source folder "{}" not found.'.format(SRCDIR))
-        sendmessage(ser, 'Source folder "{}" not found.'.format(SRCDIR))
+    segmented = collections.deque() # Large files taking turns a segment at a time
+    ser.setDTR(0) # Indicate transmission possible / in progress
 
     while True:
 
@@ -450,81 +1514,89 @@ def main():
             except Exception as e:
                 logger.critical('Exception opening serial port. Retrying...\n\tException Message: {}'.format(e))
 
+        item = scheduler.next(0 if segmented else SCANINTERVAL)
+
+        if item is not None:
+            size = os.path.getsize(os.path.join(item.cache, item.filename))
+            if SESSION['segments'] and size > SEGMENTSIZE:
+                if len(segmented) < SEGMENTEDFILES:
+                    segmented.append(SegmentedFile(item))
+                    continue
+                logger.info('{} large files already taking turns. Sending "{}" whole.'.format(len(segmented), item.filename))
+            scheduler.charge(item.feed, size)
+
+        # Staged files go first, so a small urgent file waits at most one segment
+        segfile = None
+        if item is None:
+            for turn in range(len(segmented)):
+                candidate = segmented[0]
+                segmented.rotate(-1)
+                if not candidate.item.feed.overquota():
+                    segfile = candidate
+                    item = segfile.item
+                    break
 
+        handed = False # Moved out of its srcdir (and out of inflight) by the feed's bookkeeper
         try:
-            ser.setDTR(0) # Indicate transmission possible / in progress
-            time.sleep(1)
-            ser.write(SERVERALIVESTRING)
-
-            logger.debug('-'*30 + ' Checking for files ' + '-'*30)
-
-            logger.debug(SRCDIR)
-            if os.path.exists(ROOT):
-                transfercount['successful'] = 0
-                transfercount['failed'] = 0
-
-                for root, dirs, files in os.walk(SRCDIR):
-                    logger.debug('Processing Directory(s)... \n\t%s' % (dirs))
-                    if files: logger.info('Processing file(s) in "{}": {}.'.format(root, files))
-
-                    files = removeignored(files, root)
-
-                    for f in files:
-                        filename = os.path.normpath(f)
-                        folder = root.replace(SRCDIR, '')
-                        source = os.path.join(root, f)
-
-                        if len(folder) > 0:
-                            folder = folder[1::] # Strip off leading "/"
-
-                        cache = os.path.normpath(os.path.join(CACHEDIR, folder))
-                        cachefile(root, cache, filename)
-
-                        logger.debug('Sending {}.'.format(os.path.normpath(f)))
-                        result = transferfile(ser, cache, folder, filename)
-
-                        # When using full path, shutil.move will overwrite the destination file if present
-                        if result == True:
-                            transfercount['successful'] += 1
-
-                            destination = os.path.join(root, DONEDIR, folder, f)
-                            logger.info('Moving file to "{}".'.format(destination))
-                            folderinit(os.path.join(root, DONEDIR, folder), 'Transferred subfolder')
-                            shutil.move(os.path.abspath(source), os.path.abspath(destination))
-                        else:
-                            transfercount['failed'] += 1
-
-                            destination = os.path.join(root, FAILDIR, folder, f)
-                            logger.info('Moving file to "{}".'.format(destination))
-                            folderinit(os.path.join(root, FAILDIR, folder), 'Failed subfolder')
-                            shutil.move(os.path.abspath(source), os.path.abspath(destination))
-
-                        logger.info('Deleting cached file "{}".'.format(os.path.join(cache, filename)))
-                        os.remove(os.path.join(cache, filename))
-
-                        time.sleep(1)
-
+            if item is None:
+                # Idle - report the batch that just finished and send a heartbeat
                 if transfercount['successful'] + transfercount['failed'] > 0:
-                    if transfercount['failed'] > 0 or transfercount['successful'] > 1:
-                        uploadfile(LOGFILENAME, os.path.join(SRCDIR, 'logs'))
-                        pass
+                    # With MULTIPLEX the log is streamed by the LogShipper instead
+                    if not SESSION['mux'] and (transfercount['failed'] > 0 or transfercount['successful'] > 1):
+                        # On its own thread - the first feed's mount may be stalled
+                        logcopy = threading.Thread(target=uploadfile, args=(LOGFILENAME, os.path.join(feeds[0].srcdir, 'logs')))
+                        logcopy.daemon = True
+                        logcopy.start()
                     logger.info('Transfer(s) complete ({} successful, {} failed).'.format(transfercount['successful'], transfercount['failed']))
                     logger.info('-'*30 + ' Restarting main loop ' + '-'*30 + '\n')
+                    transfercount['successful'] = 0
+                    transfercount['failed'] = 0
+
+                ser.setDTR(0) # Indicate transmission possible / in progress
+                while not PENDINGMESSAGES.empty():
+                    sendmessage(ser, PENDINGMESSAGES.get_nowait())
+                time.sleep(1)
+                if not SESSION['mux']: # Otherwise sent by the Heartbeat thread
+                    ser.write(SERVERALIVESTRING)
+                continue
+
+            folder, source, f = item.folder, item.source, item.filename
+            remotefolder = os.path.join(item.feed.prefix, folder) # Published under the feed's prefix on the client
+
+            logger.debug('Sending {}.'.format(f))
+            if segfile is not None:
+                if segfile.pending:
+                    index = segfile.pending[0]
+                    scheduler.charge(item.feed, min(SEGMENTSIZE, segfile.size - index * SEGMENTSIZE))
+                    try:
+                        segfile.sent(index, transferfile(ser, item.cache, remotefolder, f, item.hashvalue, (index, segfile.count)))
+                    except InvalidMsgError:
+                        raise
+                    except Exception:
+                        segfile.sent(index, False)
+                        raise
+                if not segfile.finished():
+                    continue
+                result = not segfile.failed
+            else:
+                result = transferfile(ser, item.cache, remotefolder, f, item.hashvalue)
 
+            if result == True:
+                transfercount['successful'] += 1
             else:
-                logger.warning('Root folder "{}" not found.  Shared folder may not be mounted.'.format(ROOT))
-                sendmessage(ser, 'Root folder "{}" not found.  Shared folder may not be mounted.'.format(ROOT))
+                transfercount['failed'] += 1
+            item.feed.bookkeeper.add(source, folder, f, result == True)
+            handed = True
+
+            time.sleep(1)
 
         except InvalidMsgError as e:
             logger.error('InvalidMsgError. {}'.format(e))
+            if segfile is not None:
+                segfile.failed = True
 
-            try:
-                destination = os.path.join(root, FAILDIR, folder, f)
-                logger.info('Moving file to "{}"'.format(destination))
-                folderinit(os.path.join(root, FAILDIR, folder), 'Transferred subfolder')
-                shutil.move(os.path.abspath(source), os.path.abspath(destination))
-            except:
-                logger.critical("Unable to move file '{}' to '{}'".format(f, destination))
+            item.feed.bookkeeper.add(source, folder, f, False)
+            handed = True
 
         except KeyboardInterrupt as e:
             logger.warning('Keyboard Interrupt. Exiting program...\n\tException Message: {}'.format(e))
@@ -532,8 +1604,23 @@ def main():
 
         except Exception as e:
             logger.critical('Exception in main loop.  Restarting...\n\tException Message: {}'.format(e))
-
-        time.sleep(15)
+            time.sleep(15)
+
+        finally:
+            if segfile is not None and segfile.finished() and segfile in segmented:
+                segmented.remove(segfile)
+            if item is not None and (segfile is None or segfile.finished()):
+                discardcached(item)
+                if not handed:
+                    with item.feed.inflightlock:
+                        item.feed.inflight.discard(item.source)
+
+    # Segments sent so far are in SEGMENTJOURNAL - the files are staged again after a restart
+    for segfile in segmented:
+        discardcached(segfile.item)
+
+    for feed in feeds:
+        feed.bookkeeper.flush()
 
 
 if __name__ == '__main__':
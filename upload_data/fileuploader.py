@@ -1,14 +1,20 @@
 #!/usr/bin/env python
 """Upload the contents of the designated source folder to Dropbox and post a notification w/ url to slack.
 Based on the Dropbox example app for API v2.
+Run with --benchmark to measure uploader throughput offline against a local stand-in for Dropbox.
 """
 
 from __future__ import print_function
 
 import argparse
+import calendar
+import collections
 import contextlib
 import datetime
+import hashlib
+import json
 import os
+import random
 import six
 import sys
 import time
@@ -18,8 +24,14 @@ import logging
 from logging.handlers import RotatingFileHandler
 import requests.packages.urllib3
 import signal
+import socket
 import configparser
+import sqlite3
 import subprocess
+import tempfile
+import threading
+import uuid
+from multiprocessing.pool import ThreadPool
 
 if sys.version.startswith('2'):
     input = raw_input
@@ -31,6 +43,54 @@ from slacker import Slacker
 PROJECTNAME = '' # Project name loaded from config file
 SLACKBOTNAME = '' # Loaded from config file
 
+# Files larger than UPLOADSESSIONTHRESHOLD are uploaded through an upload session
+#  in CHUNKSIZE pieces so memory use stays constant regardless of file size.
+#  The sessions are sequential, so appends may be any size (only concurrent
+#  sessions need 4 MB multiples) and shaped or cut-through appends are smaller.
+CHUNKSIZE = 4 * 1024 * 1024
+UPLOADSESSIONTHRESHOLD = 2 * CHUNKSIZE
+HASHBLOCKSIZE = 4 * 1024 * 1024 # Block size of the Dropbox content hash
+
+# Tunables, optionally overridden from the [Uploader] section of the config file
+OPTIONS = {
+    'workers': 4, # Number of files processed concurrently
+    'maxrequestspersecond': 8.0, # Dropbox API request pacing across all workers (0 = unlimited)
+    'shareurlttl': 3600, # Seconds a folder share URL is reused before it is requested again
+    'hashworkers': 4, # Threads used to compute the content hash of large files
+    'slackretries': 5, # Attempts to post a Slack notification before giving up
+    'slackretrydelay': 5.0, # Seconds before the first retry, doubled on each attempt
+    'eventsocket': '/tmp/fileuploader.sock', # Unix socket the receiver reports published files on
+    'reconcileinterval': 600, # Seconds between full scans of the upload source
+    'queuefile': '/var/lib/sierra/fileuploader.db', # SQLite upload queue (survives restarts)
+    'retrydelay': 60, # Seconds before a failed file is retried, doubled on each further failure
+    'maxretrydelay': 3600, # Upper limit for the retry delay
+    'listingmaxage': 60, # Seconds a cached folder listing is trusted before it is refreshed
+    'breakerthreshold': 5, # Consecutive connection failures before uploads pause for an outage
+    'breakerprobedelay': 30, # Seconds before the first connectivity probe of an outage, doubled after each failed probe
+    'breakermaxprobedelay': 600, # Upper limit for the probe delay
+    'uploadrate': '', # Upload bytes/s, either one rate or a daily schedule "HH:MM=rate, ..." (blank or 0 = unlimited)
+    'subfolderweights': '', # "subfolder=weight, ..." - files in heavier subfolders are uploaded first (default weight 1)
+    'batchsize': 100, # Small files committed together in one request (0 = upload one by one, Dropbox allows up to 1000)
+}
+
+QUEUE = None # UploadQueue, opened at startup
+BREAKER = None # CircuitBreaker guarding the storage backend, created at startup
+SHAPER = None # TokenBucket limiting upload bandwidth, created at startup
+RECEIVERDEFERRING = None # Why the receiver is deferring transfers, None while it accepts them
+
+EVENTCOALESCE = 0.2 # Seconds to keep collecting receiver events after the first arrives
+COMMANDPOLLTIMEOUT = 300 # Seconds each long poll of the commands folder stays open
+BATCHPOLLINTERVAL = 1 # Seconds between checks of an asynchronous batch commit
+SHAPEDBURST = 1 # Seconds of upload rate that may be sent at once after an idle period
+SHAPEDCHUNKTIME = 2 # Seconds of upload rate sent per request when shaping, so no request hogs the uplink
+MINSHAPEDCHUNK = 64 * 1024
+AGINGINTERVAL = 300 # Seconds of waiting that halve a queued file's effective size (so big files are not starved)
+
+LISTINGCACHE = {} # Dropbox folder path -> {'cursor': ..., 'entries': {name: metadata}, 'time': last update}
+LISTINGLOCKS = collections.defaultdict(threading.RLock) # Dropbox folder path -> lock held while its cached listing changes
+SHAREURLCACHE = {} # Dropbox folder path -> (share URL, expiry time)
+CACHELOCK = threading.Lock()
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 logger.setLevel(logging.INFO)
@@ -48,12 +108,23 @@ rfh.setFormatter(formatter)
 logger.addHandler(rfh)
 
 
-def main(slack, localuploadsource, dropboxtoken, slacktoken, slackchannel):
+def main(notifier, localuploadsource, backend, slacktoken, slackchannel, paths=None):
     """Main program.
     Parse command line, then iterate over files and directories under
     rootdir and upload all files.  Skips some temporary files and
     directories, and avoids duplicate uploads by comparing size and
     mtime with the server.
+    Files found are recorded in the upload queue (QUEUE) and the queue is
+    then drained by a pool of OPTIONS['workers'] threads so HTTP
+    round-trips overlap.  Small files are committed together in batches
+    of up to OPTIONS['batchsize'] (see UploadBatch).  Upload notifications are handed to the notifier
+    and posted as one digest per folder once the batch is done.
+    While the storage service is unreachable (BREAKER open) files are only
+    queued; the backlog is drained once a probe finds it reachable again.
+    If paths is given (files reported by the receiver), only those files
+    are added instead of walking the whole of rootdir.  Files already in
+    the queue, including failed uploads waiting for their retry time, are
+    not added twice.
     """
 
     folder = os.path.join(PROJECTNAME, 'incoming')
@@ -69,12 +140,11 @@ def main(slack, localuploadsource, dropboxtoken, slacktoken, slackchannel):
         logger.warning('{} is not a folder on your filesystem'.format(rootdir))
         sys.exit(1)
 
-    dbx = dropbox.Dropbox(dropboxtoken)
     #slack = Slacker(slacktoken)
 
-    for dn, dirs, files in os.walk(rootdir):
+    tree = os.walk(rootdir) if paths is None else eventtree(rootdir, paths)
+    for dn, dirs, files in tree:
         subfolder = dn[len(rootdir):].strip(os.path.sep)
-        listing = list_folder(dbx, folder, subfolder)
         logger.debug('Descending into {} ...'.format(subfolder))
 
         # First do all the files.
@@ -82,46 +152,14 @@ def main(slack, localuploadsource, dropboxtoken, slacktoken, slackchannel):
             fullname = os.path.join(dn, name)
             if not isinstance(name, six.text_type):
                 name = name.decode('utf-8')
-            nname = unicodedata.normalize('NFC', name)
             if name.startswith('.'):
                 print('Skipping dot file:', name)
             elif name.startswith('@') or name.endswith('~'):
                 print('Skipping temporary file:', name)
             elif name.endswith('.pyc') or name.endswith('.pyo'):
                 print('Skipping generated file:', name)
-            elif nname in listing:
-                # Probably will just want to force overwrite and not bother checking
-                md = listing[nname]
-                mtime = os.path.getmtime(fullname)
-                mtime_dt = datetime.datetime(*time.gmtime(mtime)[:6])
-                size = os.path.getsize(fullname)
-                if (isinstance(md, dropbox.files.FileMetadata) and
-                    mtime_dt == md.client_modified and size == md.size):
-                    logger.info('{} is already synced [stats match]'.format(name))
-                    deletefile(fullname)
-                else:
-                    logger.info('{} exists with different stats, downloading'.format(name))
-                    res = download(dbx, folder, subfolder, name)
-                    with open(fullname) as f:
-                        data = f.read()
-                    if res == data:
-                        logger.info('{} is already synced [content match]'.format(name))
-                        deletefile(fullname)
-                    else:
-                        logger.info('{} has changed since last sync'.format(name))
-                        
-
-                        if True: #yesno('Refresh %s' % name, False, args): # Force overwrite
-                            upload(dbx, fullname, folder, subfolder, name, overwrite=True)
-                            shareurl = getshareurl(dbx, folder, subfolder)
-                            deletefile(fullname)
-                            postslackmsg(slack, '{}'.format(slackchannel), ' uploaded *{}* to Dropbox folder (_<{}|{}>_)'.format(os.path.basename(fullname), shareurl, '/{}/{}'.format(folder, subfolder)), True)
-
-            elif True: #yesno('Upload %s' % name, True, args): #Automatically upload new files
-                upload(dbx, fullname, folder, subfolder, name)
-                deletefile(fullname)
-                shareurl = getshareurl(dbx, folder, subfolder)
-                postslackmsg(slack, '{}'.format(slackchannel), ' uploaded *{}* to Dropbox folder (_<{}|{}>_)'.format(os.path.basename(fullname), shareurl, '/{}/{}'.format(folder, subfolder)), True)
+            else:
+                QUEUE.add(fullname, folder, subfolder, name)
 
         # Then choose which subdirectories to traverse.
         keep = []
@@ -139,6 +177,532 @@ def main(slack, localuploadsource, dropboxtoken, slacktoken, slackchannel):
                 #print('OK, skipping directory:', name)
         dirs[:] = keep
 
+    ready = QUEUE.ready()
+    if not ready or not BREAKER.ready(backend):
+        return
+
+    batch = UploadBatch(backend) if OPTIONS['batchsize'] > 0 else None
+
+    def worker(index):
+        # Stop claiming as soon as an outage opens the breaker
+        while BREAKER.closed():
+            job = QUEUE.claim()
+            if job is None:
+                break
+            processfile(backend, notifier, job, batch)
+
+    workers = max(1, min(OPTIONS['workers'], ready))
+    logger.info('Processing {} queued file(s) with {} workers'.format(ready, workers))
+    pool = ThreadPool(workers)
+    try:
+        pool.map(worker, range(workers))
+        # Share, notify and delete the files the last batch committed.  That
+        #  pass can claim retries that came due meanwhile, so commit until
+        #  nothing is left in the batch
+        while batch is not None and batch.commit():
+            pool.map(worker, range(workers))
+    finally:
+        pool.close()
+        pool.join()
+        notifier.flush()
+
+def eventtree(rootdir, paths):
+    """Group reported file paths by directory in the same (dirpath, dirnames,
+    filenames) form as os.walk.  Paths outside rootdir or that no longer
+    exist (already handled by an earlier pass) are dropped.
+    """
+    rootdir = os.path.realpath(rootdir)
+    tree = collections.OrderedDict()
+    for path in paths:
+        path = os.path.realpath(path)
+        if not path.startswith(rootdir + os.path.sep) or not os.path.isfile(path):
+            continue
+        tree.setdefault(os.path.dirname(path), []).append(os.path.basename(path))
+
+    return [(dn, [], files) for dn, files in tree.items()]
+
+def openeventsocket(path):
+    '''
+    Bind the Unix datagram socket the receiver reports published files on
+    Returns None (periodic scans only) if the socket cannot be created
+    '''
+
+    try:
+        if os.path.exists(path):
+            os.unlink(path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(path)
+        os.chmod(path, 0o666)
+    except Exception as e:
+        logger.warning('Unable to open event socket "{}". Relying on periodic scans.\n\tException Message: {}'.format(path, e))
+        return None
+
+    logger.info('Listening for published files on "{}"'.format(path))
+    return sock
+
+def waitforevents(sock, timeout, cutthrough=None, notifier=None):
+    '''
+    Wait up to [timeout] seconds for the receiver to report published files
+    Once the first report arrives, reports arriving within EVENTCOALESCE
+     seconds of each other are collected so a burst is handled as one batch
+    Reports about files still being received go to cutthrough (CutThrough)
+    The receiver starting or stopping to defer transfers (its disk is nearly
+     full) is logged and posted through notifier
+    Returns the list of reported paths (empty on timeout)
+    '''
+
+    global RECEIVERDEFERRING
+
+    timeout = max(timeout, 0.01)
+    if sock is None:
+        time.sleep(timeout)
+        return []
+
+    paths = []
+    sock.settimeout(timeout)
+    while True:
+        try:
+            data = sock.recv(65536)
+        except socket.timeout:
+            break
+
+        try:
+            message = json.loads(data.decode('utf-8'))
+        except ValueError as e:
+            logger.warning('Ignoring malformed event {!r}: {}'.format(data, e))
+            continue
+
+        if message.get('event') == 'published':
+            paths.append(message['path'])
+        elif cutthrough is not None and message.get('event') in ('receiving', 'failed'):
+            cutthrough.put(message)
+        elif message.get('event') == 'deferring':
+            # Repeated while the receiver defers - only the start is announced
+            if RECEIVERDEFERRING is None:
+                logger.warning('Receiver is deferring transfers - {}'.format(message.get('reason')))
+                if notifier is not None:
+                    notifier.alert('Receiver is deferring transfers - {}'.format(message.get('reason')))
+            RECEIVERDEFERRING = message.get('reason')
+        elif message.get('event') == 'accepting':
+            if RECEIVERDEFERRING is not None:
+                logger.info('Receiver is accepting transfers again')
+                if notifier is not None:
+                    notifier.alert('Receiver is accepting transfers again')
+            RECEIVERDEFERRING = None
+        sock.settimeout(EVENTCOALESCE)
+
+    if paths and cutthrough is not None:
+        # The upload workers take over the sessions of the published files
+        cutthrough.handover(paths)
+
+    return paths
+
+def processfile(backend, notifier, job, batch=None):
+    """Sync a single queued file with cloud storage.
+    Upload it if it is new or changed, then share, notify and delete it,
+    recording each step in the queue so a restart carries on from the
+    step that was interrupted.  Runs on a worker thread; a failure puts
+    the file back in the queue with a backed-off retry time so one bad
+    file does not stop the rest of the batch.
+    Small files are handed to batch, if given, and are shared, notified and
+    deleted by a later claim once the batch has been committed.
+    """
+
+    fullname, folder, subfolder, name, state = job
+    try:
+        if state == 'uploading':
+            if not os.path.isfile(fullname):
+                logger.warning('Queued file "{}" no longer exists'.format(fullname))
+                QUEUE.setstate(fullname, 'deleted')
+                return
+
+            nname = unicodedata.normalize('NFC', name)
+            listing = list_folder(backend, folder, subfolder, maxage=OPTIONS['listingmaxage'])
+            if nname in listing:
+                # Probably will just want to force overwrite and not bother checking
+                md = listing[nname]
+                mtime = os.path.getmtime(fullname)
+                mtime_dt = datetime.datetime(*time.gmtime(mtime)[:6])
+                size = os.path.getsize(fullname)
+                if (isinstance(md, FileEntry) and
+                    mtime_dt == md.client_modified and size == md.size):
+                    logger.info('{} is already synced [stats match]'.format(name))
+                    state = 'notified' # Nothing new to announce
+                elif (isinstance(md, FileEntry) and
+                    md.content_hash == contenthash(fullname)):
+                    logger.info('{} is already synced [content hash match]'.format(name))
+                    state = 'notified'
+                else:
+                    logger.info('{} has changed since last sync'.format(name))
+                    overwrite = True # Force overwrite
+            else:
+                overwrite = False # Automatically upload new files
+
+            if (state == 'uploading' and batch is not None and
+                os.path.getsize(fullname) <= SHAPER.sessionthreshold() and QUEUE.getsession(fullname) is None):
+                batch.add(fullname, folder, subfolder, name, overwrite)
+                return
+
+            if state == 'uploading':
+                # Keep the local file if the upload failed so it is retried (and resumed) later
+                if upload(backend, fullname, folder, subfolder, name, overwrite=overwrite) is None:
+                    QUEUE.retry(fullname, 'Upload failed')
+                    return
+                state = 'uploaded'
+            QUEUE.setstate(fullname, state)
+
+        if state == 'uploaded':
+            shareurl = getshareurl(backend, folder, subfolder)
+            notifier.add('/{}/{}'.format(folder, subfolder), shareurl, os.path.basename(fullname))
+            state = 'notified'
+            QUEUE.setstate(fullname, state)
+
+        if state == 'notified':
+            deletefile(fullname)
+            QUEUE.setstate(fullname, 'deleted')
+        BREAKER.success()
+
+    except StorageUnavailableError as e:
+        logger.warning('Storage unavailable processing "{}": {}'.format(fullname, e))
+        BREAKER.failure(e)
+        QUEUE.retry(fullname, e)
+
+    except Exception as e:
+        logger.error('Exception processing "{}".\n\tException Message: {}'.format(fullname, e))
+        QUEUE.retry(fullname, e)
+
+class UploadQueue(object):
+    '''
+    Crash-safe record (SQLite) of every file the uploader is working on
+    Each file moves through the states
+      pending -> uploading -> uploaded -> notified -> deleted
+     and its row keeps the attempt count, the time of the next retry and the
+     offset of an unfinished upload session.  Workers claim the next file due
+     with one indexed query (by rank, the aged priority), and a restart (e.g. by the pidcheck cron) resumes
+     every file at the step it was interrupted in.
+    '''
+
+    def __init__(self, dbfile):
+        folderinit(os.path.dirname(dbfile), 'Upload queue folder')
+        self.db = sqlite3.connect(dbfile, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.aged = 0 # Time the ranks were last refreshed (see claim)
+
+        with self.lock, self.db:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('''CREATE TABLE IF NOT EXISTS files (
+                fullname TEXT PRIMARY KEY,
+                folder TEXT NOT NULL,
+                subfolder TEXT NOT NULL,
+                name TEXT NOT NULL,
+                state TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_retry REAL NOT NULL DEFAULT 0,
+                session_id TEXT,
+                session_offset INTEGER,
+                session_size INTEGER,
+                session_mtime REAL,
+                error TEXT,
+                updated REAL NOT NULL)''')
+            columns = [row[1] for row in self.db.execute('PRAGMA table_info(files)')]
+            for column, kind in (('priority', 'REAL'), ('queued', 'REAL'), ('rank', 'REAL'), ('claimed', 'INTEGER')):
+                if column not in columns:
+                    self.db.execute('ALTER TABLE files ADD COLUMN {} {} NOT NULL DEFAULT 0'.format(column, kind))
+            self.db.execute('CREATE INDEX IF NOT EXISTS files_due ON files (state, next_retry)')
+            # Unclaimed files waiting for a worker, in the order they are claimed
+            self.db.execute("CREATE INDEX IF NOT EXISTS files_rank ON files (rank) WHERE claimed = 0 AND state IN ('pending', 'uploaded', 'notified')")
+            # Uploads cut short by a crash or restart go back to the queue (their session is kept)
+            self.db.execute("UPDATE files SET state = 'pending' WHERE state = 'uploading'")
+            self.db.execute('UPDATE files SET claimed = 0 WHERE claimed != 0')
+            # Forget files finished (or transfers abandoned) more than a day ago
+            self.db.execute("DELETE FROM files WHERE state IN ('deleted', 'receiving') AND updated < ?", (time.time() - 86400,))
+
+        logger.info('Upload queue "{}" opened ({})'.format(dbfile, self.counts()))
+
+    def counts(self):
+        with self.lock:
+            rows = self.db.execute('SELECT state, COUNT(*) FROM files GROUP BY state').fetchall()
+        return dict(rows)
+
+    def add(self, fullname, folder, subfolder, name):
+        '''
+        Queue a file found in the upload source
+        A file already queued keeps its state (and retry time) unless it was
+         finished earlier, in which case it is a new file with the same name
+        Files are claimed smallest first, with the size divided by the weight
+         of their subfolder (see subfolderweight)
+        '''
+        now = time.time()
+        try:
+            priority = os.path.getsize(fullname) / subfolderweight(subfolder)
+        except OSError:
+            priority = 0
+        with self.lock, self.db:
+            cur = self.db.execute("INSERT OR IGNORE INTO files (fullname, folder, subfolder, name, state, priority, rank, queued, updated) VALUES (?, ?, ?, ?, 'pending', ?, ?, ?, ?)", (fullname, folder, subfolder, name, priority, priority, now, now))
+            if cur.rowcount == 0:
+                self.db.execute("UPDATE files SET state = 'pending', attempts = 0, next_retry = 0, error = NULL, priority = ?, rank = ?, queued = ?, updated = ? WHERE fullname = ? AND state = 'deleted'", (priority, priority, now, now, fullname))
+                # Published after a cut-through upload started - keep its session
+                self.db.execute("UPDATE files SET state = 'pending', priority = ?, rank = ?, updated = ? WHERE fullname = ? AND state = 'receiving'", (priority, priority, now, fullname))
+
+    def receiving(self, fullname, folder, subfolder, name):
+        '''
+        Record a file the receiver is still writing (see CutThrough)
+        Returns False if a file of the same name is already queued for upload
+        '''
+        now = time.time()
+        with self.lock, self.db:
+            self.db.execute("INSERT OR IGNORE INTO files (fullname, folder, subfolder, name, state, queued, updated) VALUES (?, ?, ?, ?, 'receiving', ?, ?)", (fullname, folder, subfolder, name, now, now))
+            self.db.execute("UPDATE files SET state = 'receiving', attempts = 0, next_retry = 0, error = NULL, queued = ?, updated = ? WHERE fullname = ? AND state = 'deleted'", (now, now, fullname))
+            return self.db.execute('SELECT state FROM files WHERE fullname = ?', (fullname,)).fetchone()[0] == 'receiving'
+
+    def forget(self, fullname):
+        '''
+        Drop a file that was being received but failed verification
+        '''
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM files WHERE fullname = ? AND state = 'receiving'", (fullname,))
+
+    def ready(self):
+        '''
+        Number of files that can be worked on now
+        '''
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM files WHERE state IN ('pending', 'uploaded', 'notified') AND next_retry <= ?", (time.time(),)).fetchone()[0]
+
+    def claim(self):
+        '''
+        Claim the next file that is due for a worker
+        Small files (weighted by subfolder) go first; the longer a file has been
+         queued the smaller it counts, so large files still get their turn.
+         That aged priority is kept in the indexed rank column, refreshed
+         every AGINGINTERVAL seconds, so a claim does not sort the whole table.
+        Returns (fullname, folder, subfolder, name, state) or None if nothing is due.
+        Pending files are marked as uploading; files that were already uploaded
+         or notified continue from that step.  Either way the row is marked
+         claimed until the file is released, retried or deleted.
+        '''
+        with self.lock, self.db:
+            now = time.time()
+            if now - self.aged >= AGINGINTERVAL:
+                self.db.execute("UPDATE files SET rank = priority / (1 + (? - queued) / ?) WHERE state IN ('pending', 'uploaded', 'notified')", (now, float(AGINGINTERVAL)))
+                self.aged = now
+            row = self.db.execute("SELECT fullname, folder, subfolder, name, state FROM files INDEXED BY files_rank WHERE claimed = 0 AND state IN ('pending', 'uploaded', 'notified') AND next_retry <= ? ORDER BY rank LIMIT 1", (now,)).fetchone()
+            if row is None:
+                return None
+
+            fullname, folder, subfolder, name, state = row
+            if state == 'pending':
+                state = 'uploading'
+                self.db.execute("UPDATE files SET state = ?, attempts = attempts + 1, claimed = 1, updated = ? WHERE fullname = ?", (state, time.time(), fullname))
+            else:
+                self.db.execute("UPDATE files SET claimed = 1 WHERE fullname = ?", (fullname,))
+
+        return fullname, folder, subfolder, name, state
+
+    def setstate(self, fullname, state):
+        with self.lock, self.db:
+            self.db.execute('UPDATE files SET state = ?, error = NULL, updated = ? WHERE fullname = ?', (state, time.time(), fullname))
+            if state in ('deleted', 'notified', 'uploaded'):
+                self.db.execute('UPDATE files SET session_id = NULL, session_offset = NULL WHERE fullname = ?', (fullname,))
+            if state == 'deleted':
+                self.db.execute('UPDATE files SET claimed = 0 WHERE fullname = ?', (fullname,))
+
+    def release(self, fullname):
+        '''
+        Let another claim pick up a file again (e.g. once its batch is committed)
+        '''
+        with self.lock, self.db:
+            self.db.execute('UPDATE files SET claimed = 0 WHERE fullname = ?', (fullname,))
+
+    def retry(self, fullname, error):
+        '''
+        Put a failed file back in the queue, retrying after a delay that doubles
+         with each failed attempt (up to OPTIONS['maxretrydelay'])
+        Failures caused by an outage (StorageUnavailableError) do not count as
+         an attempt and the file is due again at once - BREAKER paces retries
+         until the service is back, and the backlog then drains without delay
+        '''
+        with self.lock, self.db:
+            row = self.db.execute('SELECT attempts, state FROM files WHERE fullname = ?', (fullname,)).fetchone()
+            if row is not None:
+                attempts, state = row
+                if isinstance(error, StorageUnavailableError):
+                    attempts = max(attempts - 1, 0)
+                    delay = 0
+                else:
+                    delay = min(OPTIONS['retrydelay'] * 2 ** max(attempts - 1, 0), OPTIONS['maxretrydelay'])
+                if state == 'uploading':
+                    state = 'pending'
+                self.db.execute('UPDATE files SET state = ?, attempts = ?, next_retry = ?, error = ?, claimed = 0, updated = ? WHERE fullname = ?', (state, attempts, time.time() + delay, '{}'.format(error), time.time(), fullname))
+                logger.warning('"{}" will be retried in {} seconds (attempt {} failed: {})'.format(fullname, delay, attempts, error))
+
+    def nextretry(self):
+        '''
+        Time the next queued file becomes due (infinity if nothing is waiting)
+        '''
+        with self.lock:
+            due = self.db.execute("SELECT MIN(next_retry) FROM files WHERE state IN ('pending', 'uploaded', 'notified')").fetchone()[0]
+        return float('inf') if due is None else due
+
+    def getsession(self, fullname):
+        with self.lock:
+            row = self.db.execute('SELECT session_id, session_offset, session_size, session_mtime FROM files WHERE fullname = ? AND session_id IS NOT NULL', (fullname,)).fetchone()
+        if row is None:
+            return None
+        return {'session_id': row[0], 'offset': row[1], 'size': row[2], 'mtime': row[3]}
+
+    def savesession(self, fullname, session, state=None):
+        '''
+        Record the progress of an upload session (None to forget it)
+        If [state] is given the session is only recorded while the file is in
+         that state (CutThrough stops once the file is queued for upload)
+        Returns True if the session was recorded
+        '''
+        if session is None:
+            session = {'session_id': None, 'offset': None, 'size': None, 'mtime': None}
+        query = 'UPDATE files SET session_id = ?, session_offset = ?, session_size = ?, session_mtime = ? WHERE fullname = ?'
+        args = (session['session_id'], session['offset'], session['size'], session['mtime'], fullname)
+        if state is not None:
+            query += ' AND state = ?'
+            args += (state,)
+        with self.lock, self.db:
+            return self.db.execute(query, args).rowcount > 0
+
+class CircuitBreaker(object):
+    '''
+    Pauses uploads while the storage service is unreachable
+    After OPTIONS['breakerthreshold'] consecutive StorageUnavailableErrors the
+     breaker opens: workers stop claiming files and, instead of every queued
+     file failing after its own timeout, a single cheap request (ping) probes
+     the service after a delay that doubles with each failed probe.  A
+     successful probe closes the breaker and the backlog is drained at full
+     concurrency again.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened = None # Time the breaker opened, None while closed
+        self.probedelay = OPTIONS['breakerprobedelay']
+        self.nextprobe = 0
+
+    def closed(self):
+        return self.opened is None
+
+    def nextattempt(self):
+        '''
+        Time uploads may be attempted again (0 while closed)
+        '''
+        return 0 if self.opened is None else self.nextprobe
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            if self.opened is not None:
+                logger.warning('Storage service reachable again after {:.0f} seconds. Resuming uploads.'.format(time.time() - self.opened))
+                self.opened = None
+                self.probedelay = OPTIONS['breakerprobedelay']
+
+    def failure(self, error, probe=False):
+        with self.lock:
+            self.failures += 1
+            if self.opened is None:
+                if self.failures < OPTIONS['breakerthreshold']:
+                    return
+                self.opened = time.time()
+                logger.critical('Storage service unreachable ({} consecutive failures, last: {}). Pausing uploads.'.format(self.failures, error))
+            elif probe:
+                self.probedelay = min(self.probedelay * 2, OPTIONS['breakermaxprobedelay'])
+            else:
+                return # Request that was already in flight when the breaker opened
+            self.nextprobe = time.time() + self.probedelay
+            logger.warning('Next connectivity probe in {} seconds'.format(self.probedelay))
+
+    def ready(self, backend):
+        '''
+        True if uploads may go ahead
+        While open, probes the service once the probe delay has passed
+        '''
+        if self.opened is None:
+            return True
+        if time.time() < self.nextprobe:
+            return False
+        try:
+            backend.ping()
+        except StorageUnavailableError as err:
+            self.failure(err, probe=True)
+            return False
+        except StorageError as err:
+            # Reachable but refusing (e.g. revoked token) - stay open and keep backing off
+            logger.critical('Storage service refused the connectivity probe: {}'.format(err))
+            self.failure(err, probe=True)
+            return False
+        self.success()
+        return True
+
+class UploadBatch(object):
+    '''
+    Small files waiting to be committed together
+    Each file is sent in a closed upload session of its own as soon as it is
+     added, so the uploads overlap across workers, and up to
+     OPTIONS['batchsize'] sessions are then committed with a single
+     finish-batch request instead of one upload request per file.
+    '''
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.lock = threading.Lock()
+        self.pending = [] # (fullname, name, (sessionid, offset, path, overwrite, client_modified))
+
+    def add(self, fullname, folder, subfolder, name, overwrite):
+        path = cloudpath(folder, subfolder, name)
+        mtime = os.path.getmtime(fullname)
+        client_modified = datetime.datetime(*time.gmtime(mtime)[:6])
+        with open(fullname, 'rb') as f:
+            data = f.read()
+        SHAPER.consume(len(data))
+        sessionid = self.backend.sessionstart(data, close=True)
+
+        with self.lock:
+            self.pending.append((fullname, name, (sessionid, len(data), path, overwrite, client_modified)))
+            full = len(self.pending) >= OPTIONS['batchsize']
+        if full:
+            self.commit()
+
+    def commit(self):
+        '''
+        Commit the files added so far and mark them uploaded in the queue
+        Failed files are put back in the queue for a retry.
+        Returns the number of files committed
+        '''
+        with self.lock:
+            pending, self.pending = self.pending, []
+        if not pending:
+            return 0
+
+        with stopwatch('commit batch of %d files' % len(pending)):
+            try:
+                results = self.backend.finishbatch([commit for fullname, name, commit in pending])
+            except (StorageError, StorageUnavailableError) as err:
+                logger.warning('*** API error committing batch of {} files: {}'.format(len(pending), err))
+                results = [err] * len(pending)
+                if isinstance(err, StorageUnavailableError):
+                    BREAKER.failure(err)
+
+        committed = 0
+        for (fullname, name, commit), res in zip(pending, results):
+            if isinstance(res, FileEntry):
+                logger.info('Uploaded as {}'.format(res.name.encode('utf8')))
+                cacheentry(commit[2], res)
+                QUEUE.setstate(fullname, 'uploaded')
+                QUEUE.release(fullname)
+                BREAKER.success()
+                committed += 1
+            else:
+                logger.warning('*** API error: {}'.format(res))
+                QUEUE.retry(fullname, res)
+
+        return committed
 
 def deletefile(fullname):
     logger.info('Deleting uploaded file "{}"'.format(fullname))
@@ -155,6 +719,7 @@ def postslackmsg(obj, channel, message, pname=True):
     Posts a message to the provided Slack channel as a bot
     The message defaults to including a prepended Project name (PROJECTNAME)
      as long as the pname argument is True
+    Returns True if the message was posted
     '''
 
     botname = SLACKBOTNAME
@@ -165,8 +730,613 @@ def postslackmsg(obj, channel, message, pname=True):
             obj.chat.post_message(channel, '{}'.format(message), username=botname, as_user=False) #True)  
     except Exception as e:
         logger.warning('Slack message post failed ({}).\n\tException Message: {}'.format(message, e))
+        return False
 
-    return
+    return True
+
+class SlackNotifier(threading.Thread):
+    '''
+    Posts upload notifications from a background thread
+    Notifications added during a scan are coalesced per Dropbox folder and
+     queued as one digest message per folder when flush() is called.
+    Posting retries with exponential backoff so a slow or rate limited
+     Slack API never holds up the uploads themselves.
+    '''
+
+    def __init__(self, slack, channel):
+        super(SlackNotifier, self).__init__()
+        self.daemon = True
+        self.slack = slack
+        self.channel = channel
+        self.lock = threading.Lock()
+        self.pending = collections.OrderedDict() # Dropbox folder -> [share url, [file names]]
+        self.messages = six.moves.queue.Queue()
+
+    def add(self, dbxfolder, shareurl, filename):
+        with self.lock:
+            entry = self.pending.setdefault(dbxfolder, ['', []])
+            entry[0] = shareurl or entry[0]
+            entry[1].append(filename)
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, collections.OrderedDict()
+
+        for dbxfolder, (shareurl, filenames) in pending.items():
+            self.messages.put(digestmessage(dbxfolder, shareurl, filenames))
+
+    def alert(self, message):
+        '''
+        Queue [message] to be posted now rather than with the next digest
+        '''
+        self.messages.put(message)
+
+    def close(self, timeout):
+        '''
+        Queue anything still pending and give the thread [timeout] seconds to post it
+        '''
+        self.flush()
+        self.messages.put(None)
+        self.join(timeout)
+
+    def run(self):
+        while True:
+            message = self.messages.get()
+            if message is None:
+                break
+            self.post(message)
+
+    def post(self, message):
+        delay = OPTIONS['slackretrydelay']
+        for attempt in range(1, OPTIONS['slackretries'] + 1):
+            if postslackmsg(self.slack, self.channel, message, True):
+                return
+            logger.warning('Slack post attempt {} of {} failed. Retrying in {} seconds.'.format(attempt, OPTIONS['slackretries'], delay))
+            time.sleep(delay)
+            delay *= 2
+
+        logger.error('Giving up on Slack message after {} attempts: {}'.format(OPTIONS['slackretries'], message))
+
+def digestmessage(dbxfolder, shareurl, filenames):
+    '''
+    Build one Slack message describing all files uploaded to a Dropbox folder
+    '''
+
+    link = '(_<{}|{}>_)'.format(shareurl, dbxfolder)
+    if len(filenames) == 1:
+        return ' uploaded *{}* to Dropbox folder {}'.format(filenames[0], link)
+
+    listed = ', '.join('*{}*'.format(name) for name in filenames[:10])
+    if len(filenames) > 10:
+        listed = '{} and {} more'.format(listed, len(filenames) - 10)
+    return ' uploaded {} files to Dropbox folder {}: {}'.format(len(filenames), link, listed)
+
+class Throttle(object):
+    """Spaces out calls so no more than [rate] start per second across all threads."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.lock = threading.Lock()
+        self.nextcall = 0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            delay = self.nextcall - now
+            self.nextcall = max(now, self.nextcall) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+class ThrottledAdapter(requests.adapters.HTTPAdapter):
+    """HTTP adapter that paces every request (including SDK retries) through a Throttle."""
+
+    def __init__(self, throttle, **kwargs):
+        self.throttle = throttle
+        super(ThrottledAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        self.throttle.wait()
+        return super(ThrottledAdapter, self).send(request, **kwargs)
+
+class TokenBucket(object):
+    """Token bucket limiting the upload bytes sent per second.
+    The rate follows a daily schedule (see parseschedule) so uploads can be
+    held back during the day and use more of the uplink at night; a rate of
+    0 is unlimited.  Every sender reserves its bytes and waits until the
+    bucket has paid for them, so concurrent uploads share the rate in
+    arrival order.  Priority senders (command responses) go ahead at once
+    but their bytes still count against the bucket.
+    """
+
+    def __init__(self, schedule):
+        self.schedule = parseschedule(schedule)
+        self.lock = threading.Lock()
+        self.tokens = 0
+        self.last = time.time()
+
+    def rate(self):
+        '''
+        Upload rate in effect now (bytes/s, 0 = unlimited)
+        '''
+        if not self.schedule:
+            return 0
+        now = time.localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        rate = self.schedule[-1][1] # Before the first entry of the day the last one still applies
+        for start, entryrate in self.schedule:
+            if start <= minute:
+                rate = entryrate
+        return rate
+
+    def chunksize(self):
+        '''
+        Bytes to send per request, small enough that a single request
+         does not saturate a limited uplink
+        '''
+        rate = self.rate()
+        if not rate:
+            return CHUNKSIZE
+        return int(max(MINSHAPEDCHUNK, min(CHUNKSIZE, rate * SHAPEDCHUNKTIME)))
+
+    def sessionthreshold(self):
+        return UPLOADSESSIONTHRESHOLD * self.chunksize() // CHUNKSIZE
+
+    def consume(self, nbytes, priority=False):
+        rate = self.rate()
+        if not rate:
+            return
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.tokens + (now - self.last) * rate, rate * SHAPEDBURST)
+            self.last = now
+            self.tokens -= nbytes
+            delay = -self.tokens / rate
+        if delay > 0 and not priority:
+            logger.debug('Upload rate {:,.0f} bytes/s - waiting {:.1f}s to send {:,} bytes'.format(rate, delay, nbytes))
+            time.sleep(delay)
+
+def parseschedule(schedule):
+    '''
+    Parse an upload rate schedule: a single rate, or "HH:MM=rate" entries
+     separated by commas, each rate (bytes/s) applying from its time of day
+     until the next entry.  E.g. "07:00=20000, 20:00=0" limits uploads to
+     20 kB/s during the day and lifts the limit at night.
+    Returns a sorted list of (minute of day, rate)
+    '''
+
+    entries = []
+    for item in schedule.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if '=' in item:
+            start, rate = item.split('=', 1)
+            hours, minutes = start.strip().split(':')
+            entries.append((int(hours) * 60 + int(minutes), float(rate)))
+        else:
+            entries.append((0, float(item)))
+    return sorted(entries)
+
+def subfolderweight(subfolder):
+    '''
+    Weight of a local subfolder from OPTIONS['subfolderweights']
+    ("subfolder=weight, ...", matched on the first path component)
+    '''
+
+    top = subfolder.strip(os.path.sep).split(os.path.sep)[0]
+    for item in OPTIONS['subfolderweights'].split(','):
+        if '=' in item:
+            name, weight = item.split('=', 1)
+            if name.strip() == top:
+                return max(float(weight), 0.001)
+    return 1.0
+
+FileEntry = collections.namedtuple('FileEntry', 'name size client_modified content_hash')
+FolderEntry = collections.namedtuple('FolderEntry', 'name')
+
+class StorageError(Exception):
+    '''The storage service rejected a request (path not found, conflict, ...)'''
+    pass
+
+class StorageUnavailableError(Exception):
+    '''The storage service could not be reached or failed transiently'''
+    pass
+
+class UploadOffsetError(StorageError):
+    '''An upload session is at a different offset than the one the client sent'''
+
+    def __init__(self, offset):
+        super(UploadOffsetError, self).__init__('Upload session is at offset {}'.format(offset))
+        self.offset = offset
+
+class StorageBackend(object):
+    """Cloud storage used by the uploader.
+    Paths are absolute '/' separated paths in the remote store.  Listings
+    map names to FileEntry/FolderEntry tuples and come with a cursor that
+    listfoldercontinue() turns into the list of (name, entry) changes since,
+    with entry None for deleted names.  Every request is counted in calls.
+    """
+
+    name = ''
+
+    def __init__(self):
+        self.calls = 0
+        self.callslock = threading.Lock()
+
+    def countcall(self):
+        with self.callslock:
+            self.calls += 1
+
+    def ping(self):
+        """Make the cheapest request the service offers, to check it is reachable."""
+        raise NotImplementedError
+
+    def listfolder(self, path):
+        """Return ({name: entry}, cursor) for the folder."""
+        raise NotImplementedError
+
+    def listfoldercontinue(self, cursor):
+        """Return ([(name, entry or None)], cursor) with the changes since cursor."""
+        raise NotImplementedError
+
+    def latestcursor(self, path):
+        """Return a cursor for the current state of the folder without listing it."""
+        raise NotImplementedError
+
+    def longpoll(self, cursor, timeout):
+        """Wait up to timeout seconds for changes since cursor.
+        Return (changes, backoff) where backoff is seconds to wait before polling again."""
+        raise NotImplementedError
+
+    def upload(self, data, path, overwrite, client_modified):
+        """Store data at path in a single request and return its FileEntry."""
+        raise NotImplementedError
+
+    def sessionstart(self, data, close=False):
+        """Start an upload session with the first chunk and return its id.
+        A closed session takes no more data and can be committed by finishbatch()."""
+        raise NotImplementedError
+
+    def sessionappend(self, sessionid, offset, data):
+        """Append a chunk at offset.  Raises UploadOffsetError on a mismatch."""
+        raise NotImplementedError
+
+    def sessionfinish(self, sessionid, offset, data, path, overwrite, client_modified):
+        """Append the last chunk, commit the session to path and return its FileEntry."""
+        raise NotImplementedError
+
+    def finishbatch(self, commits):
+        """Commit closed sessions given as (sessionid, offset, path, overwrite,
+        client_modified) tuples in one request.
+        Return a FileEntry or StorageError for each, in the same order."""
+        raise NotImplementedError
+
+    def download(self, path):
+        """Return the contents of the file at path."""
+        raise NotImplementedError
+
+    def sharedlink(self, path):
+        """Return a share URL for path."""
+        raise NotImplementedError
+
+    def delete(self, path):
+        raise NotImplementedError
+
+class DropboxBackend(StorageBackend):
+    """Dropbox storage through the Dropbox SDK.
+    One client, and its keep-alive connection pool, is shared by every
+    uploader component.  The pool is large enough for all upload workers
+    plus the command poller and requests are paced to stay under the API
+    rate limit.  The SDK itself retries rate limited (HTTP 429) calls after
+    the requested backoff.
+    """
+
+    name = 'dropbox'
+
+    def __init__(self, dropboxtoken):
+        super(DropboxBackend, self).__init__()
+        connections = max(1, OPTIONS['workers']) + 2
+        session = requests.Session()
+        session.mount('https://', ThrottledAdapter(Throttle(OPTIONS['maxrequestspersecond']), pool_connections=connections, pool_maxsize=connections))
+        self.dbx = dropbox.Dropbox(dropboxtoken, session=session)
+
+    def call(self, func, *args, **kwargs):
+        '''
+        Make an SDK call, translating its errors into StorageError (the request
+         was refused) and StorageUnavailableError (network or server failure)
+        Only connection errors, HTTP 5xx and 429 (rate limited) mean the
+         service is unavailable.  Other HTTP errors (bad token, bad input)
+         will not go away by retrying at once and are StorageErrors.
+        '''
+        self.countcall()
+        try:
+            return func(*args, **kwargs)
+        except dropbox.exceptions.ApiError as err:
+            offset = incorrectoffset(err)
+            if offset is not None:
+                raise UploadOffsetError(offset)
+            raise StorageError(err)
+        except dropbox.exceptions.HttpError as err:
+            status = getattr(err, 'status_code', None)
+            if isinstance(err, (dropbox.exceptions.RateLimitError, dropbox.exceptions.InternalServerError)) or status == 429 or (status or 0) >= 500:
+                raise StorageUnavailableError(err)
+            raise StorageError(err)
+        except requests.exceptions.RequestException as err:
+            raise StorageUnavailableError(err)
+
+    @staticmethod
+    def toentry(md):
+        if isinstance(md, FileMetadata):
+            return FileEntry(md.name, md.size, md.client_modified, md.content_hash)
+        elif isinstance(md, FolderMetadata):
+            return FolderEntry(md.name)
+        return None # Deleted
+
+    @staticmethod
+    def writemode(overwrite):
+        return dropbox.files.WriteMode.overwrite if overwrite else dropbox.files.WriteMode.add
+
+    def changes(self, res):
+        '''
+        Follow has_more pages of a listing result
+        Returns the [(name, entry)] changes and the final cursor
+        '''
+        changes = []
+        while True:
+            changes.extend((md.name, self.toentry(md)) for md in res.entries)
+            if not res.has_more:
+                return changes, res.cursor
+            res = self.call(self.dbx.files_list_folder_continue, res.cursor)
+
+    def ping(self):
+        self.call(self.dbx.users_get_current_account)
+
+    def listfolder(self, path):
+        changes, cursor = self.changes(self.call(self.dbx.files_list_folder, path))
+        return dict((name, entry) for name, entry in changes if entry is not None), cursor
+
+    def listfoldercontinue(self, cursor):
+        return self.changes(self.call(self.dbx.files_list_folder_continue, cursor))
+
+    def latestcursor(self, path):
+        return self.call(self.dbx.files_list_folder_get_latest_cursor, path).cursor
+
+    def longpoll(self, cursor, timeout):
+        res = self.call(self.dbx.files_list_folder_longpoll, cursor, timeout=timeout)
+        return res.changes, res.backoff or 0
+
+    def upload(self, data, path, overwrite, client_modified):
+        md = self.call(self.dbx.files_upload, data, path, self.writemode(overwrite), client_modified=client_modified, mute=True)
+        return self.toentry(md)
+
+    def sessionstart(self, data, close=False):
+        return self.call(self.dbx.files_upload_session_start, data, close=close).session_id
+
+    def sessionappend(self, sessionid, offset, data):
+        cursor = dropbox.files.UploadSessionCursor(session_id=sessionid, offset=offset)
+        self.call(self.dbx.files_upload_session_append_v2, data, cursor)
+
+    def sessionfinish(self, sessionid, offset, data, path, overwrite, client_modified):
+        cursor = dropbox.files.UploadSessionCursor(session_id=sessionid, offset=offset)
+        commit = dropbox.files.CommitInfo(path=path, mode=self.writemode(overwrite), client_modified=client_modified, mute=True)
+        return self.toentry(self.call(self.dbx.files_upload_session_finish, data, cursor, commit))
+
+    def finishbatch(self, commits):
+        entries = [dropbox.files.UploadSessionFinishArg(
+            cursor=dropbox.files.UploadSessionCursor(session_id=sessionid, offset=offset),
+            commit=dropbox.files.CommitInfo(path=path, mode=self.writemode(overwrite), client_modified=client_modified, mute=True))
+            for sessionid, offset, path, overwrite, client_modified in commits]
+        launch = self.call(self.dbx.files_upload_session_finish_batch, entries)
+        if launch.is_complete():
+            res = launch.get_complete()
+        elif launch.is_async_job_id():
+            jobid = launch.get_async_job_id()
+            while True:
+                time.sleep(BATCHPOLLINTERVAL)
+                status = self.call(self.dbx.files_upload_session_finish_batch_check, jobid)
+                if status.is_complete():
+                    res = status.get_complete()
+                    break
+        else:
+            raise StorageError('Unexpected batch commit result: {}'.format(launch))
+
+        return [self.toentry(entry.get_success()) if entry.is_success() else StorageError(entry.get_failure())
+                for entry in res.entries]
+
+    def download(self, path):
+        md, res = self.call(self.dbx.files_download, path)
+        return res.content
+
+    def sharedlink(self, path):
+        return self.call(self.dbx.sharing_create_shared_link, path, short_url=True, pending_upload=None).url
+
+    def delete(self, path):
+        self.call(self.dbx.files_delete, path)
+
+class LocalBackend(StorageBackend):
+    """Stand-in for Dropbox that keeps files in a local folder.
+    Used to measure and tune the uploader without an account or a network.
+    Every request is delayed by latency seconds plus its payload size
+    divided by bandwidth (bytes/s, 0 = unlimited), and fails with
+    StorageUnavailableError with probability errorrate.
+    """
+
+    name = 'local'
+
+    def __init__(self, rootdir, latency=0, bandwidth=0, errorrate=0):
+        super(LocalBackend, self).__init__()
+        self.rootdir = rootdir
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.errorrate = errorrate
+        self.lock = threading.Lock()
+        self.cursors = {} # Cursor -> (path, {name: entry}) snapshot
+        self.sessions = {} # Session id -> partial file
+        self.hashes = {} # Local file -> (size, mtime, content hash)
+        folderinit(rootdir, 'Local backend root')
+        self.tempdir = tempfile.mkdtemp(prefix='localbackend-', dir=os.path.dirname(os.path.abspath(rootdir)))
+
+    def call(self, nbytes=0):
+        self.countcall()
+        delay = self.latency + (float(nbytes) / self.bandwidth if self.bandwidth else 0)
+        if delay > 0:
+            time.sleep(delay)
+        if random.random() < self.errorrate:
+            raise StorageUnavailableError('Injected failure')
+
+    def localpath(self, path):
+        return os.path.join(self.rootdir, *[part for part in path.split('/') if part])
+
+    def entry(self, localpath):
+        name = os.path.basename(localpath)
+        if os.path.isdir(localpath):
+            return FolderEntry(name)
+
+        st = os.stat(localpath)
+        with self.lock:
+            cached = self.hashes.get(localpath)
+        if cached is None or cached[:2] != (st.st_size, st.st_mtime):
+            cached = (st.st_size, st.st_mtime, contenthash(localpath))
+            with self.lock:
+                self.hashes[localpath] = cached
+        return FileEntry(name, st.st_size, datetime.datetime(*time.gmtime(st.st_mtime)[:6]), cached[2])
+
+    def snapshot(self, path):
+        localpath = self.localpath(path)
+        if not os.path.isdir(localpath):
+            raise StorageError('path/not_found: {}'.format(path))
+        return dict((name, self.entry(os.path.join(localpath, name))) for name in os.listdir(localpath))
+
+    def newcursor(self, path, snapshot):
+        cursor = uuid.uuid4().hex
+        with self.lock:
+            self.cursors[cursor] = (path, snapshot)
+        return cursor
+
+    def diff(self, cursor):
+        with self.lock:
+            state = self.cursors.get(cursor)
+        if state is None:
+            raise StorageError('reset: {}'.format(cursor))
+        path, before = state
+        after = self.snapshot(path)
+        changes = [(name, None) for name in before if name not in after]
+        changes.extend((name, entry) for name, entry in after.items() if before.get(name) != entry)
+        return changes, path, after
+
+    def ping(self):
+        self.call()
+
+    def listfolder(self, path):
+        self.call()
+        snapshot = self.snapshot(path)
+        return dict(snapshot), self.newcursor(path, snapshot)
+
+    def listfoldercontinue(self, cursor):
+        self.call()
+        changes, path, after = self.diff(cursor)
+        with self.lock:
+            self.cursors.pop(cursor, None)
+        return changes, self.newcursor(path, after)
+
+    def latestcursor(self, path):
+        self.call()
+        return self.newcursor(path, self.snapshot(path))
+
+    def longpoll(self, cursor, timeout):
+        self.call()
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.diff(cursor)[0]:
+                return True, 0
+            time.sleep(1)
+        return False, 0
+
+    def commit(self, partfile, path, overwrite, client_modified):
+        localpath = self.localpath(path)
+        if not overwrite and os.path.exists(localpath):
+            os.remove(partfile)
+            raise StorageError('path/conflict: {}'.format(path))
+        folderinit(os.path.dirname(localpath), 'Local backend folder')
+        mtime = calendar.timegm(client_modified.timetuple())
+        os.utime(partfile, (mtime, mtime))
+        shutil.move(partfile, localpath)
+        return self.entry(localpath)
+
+    def upload(self, data, path, overwrite, client_modified):
+        self.call(len(data))
+        partfile = os.path.join(self.tempdir, uuid.uuid4().hex)
+        with open(partfile, 'wb') as f:
+            f.write(data)
+        return self.commit(partfile, path, overwrite, client_modified)
+
+    def sessionfile(self, sessionid, offset):
+        with self.lock:
+            partfile = self.sessions.get(sessionid)
+        if partfile is None:
+            raise StorageError('upload_session/not_found: {}'.format(sessionid))
+        if os.path.getsize(partfile) != offset:
+            raise UploadOffsetError(os.path.getsize(partfile))
+        return partfile
+
+    def sessionstart(self, data, close=False):
+        self.call(len(data))
+        sessionid = uuid.uuid4().hex
+        partfile = os.path.join(self.tempdir, sessionid)
+        with open(partfile, 'wb') as f:
+            f.write(data)
+        with self.lock:
+            self.sessions[sessionid] = partfile
+        return sessionid
+
+    def sessionappend(self, sessionid, offset, data):
+        self.call(len(data))
+        with open(self.sessionfile(sessionid, offset), 'ab') as f:
+            f.write(data)
+
+    def sessionfinish(self, sessionid, offset, data, path, overwrite, client_modified):
+        self.sessionappend(sessionid, offset, data)
+        with self.lock:
+            partfile = self.sessions.pop(sessionid)
+        return self.commit(partfile, path, overwrite, client_modified)
+
+    def finishbatch(self, commits):
+        self.call()
+        results = []
+        for sessionid, offset, path, overwrite, client_modified in commits:
+            try:
+                partfile = self.sessionfile(sessionid, offset)
+                with self.lock:
+                    self.sessions.pop(sessionid)
+                results.append(self.commit(partfile, path, overwrite, client_modified))
+            except StorageError as err:
+                results.append(err)
+        return results
+
+    def download(self, path):
+        localpath = self.localpath(path)
+        if not os.path.isfile(localpath):
+            self.call()
+            raise StorageError('path/not_found: {}'.format(path))
+        self.call(os.path.getsize(localpath))
+        with open(localpath, 'rb') as f:
+            return f.read()
+
+    def sharedlink(self, path):
+        self.call()
+        return 'file://{}'.format(self.localpath(path))
+
+    def delete(self, path):
+        self.call()
+        localpath = self.localpath(path)
+        if os.path.isdir(localpath):
+            shutil.rmtree(localpath)
+        elif os.path.isfile(localpath):
+            os.remove(localpath)
+        else:
+            raise StorageError('path_lookup/not_found: {}'.format(path))
 
 def getpid():
     '''
@@ -241,22 +1411,52 @@ def getconfig(configfile):
 
     return #projectname, uploadsource, dropboxtoken, slacktoken, slackchannel
 
-def getshareurl(dbx, folder, subfolder):
+def getoptions(configfile):
     '''
-    Create a share URL for the requested Dropbox folder and return it
+    Read the optional [Uploader] section of the config file into OPTIONS
+    Options that are not present keep their defaults
+    '''
+
+    config = configparser.ConfigParser()
+    config.read(configfile)
+
+    if config.has_section('Uploader'):
+        for key, default in OPTIONS.items():
+            if not config.has_option('Uploader', key):
+                continue
+            if isinstance(default, bool):
+                OPTIONS[key] = config.getboolean('Uploader', key)
+            else:
+                OPTIONS[key] = type(default)(config.get('Uploader', key))
+
+    return OPTIONS
+
+def getshareurl(backend, folder, subfolder):
+    '''
+    Create a share URL for the requested cloud folder and return it
+    URLs are cached per folder for OPTIONS['shareurlttl'] seconds so a batch
+     of uploads to the same folder only creates the link once
     '''
 
     dbxfolder = '/{}/{}'.format(folder, subfolder)
     dbxfolder = dbxfolder.rstrip('/')
+
+    with CACHELOCK:
+        cached = SHAREURLCACHE.get(dbxfolder)
+    if cached is not None and cached[1] > time.time():
+        return cached[0]
+
     try:
-        share = dbx.sharing_create_shared_link(dbxfolder, short_url=True, pending_upload=None)
+        shareurl = backend.sharedlink(dbxfolder)
     except Exception as e:
-        logger.critical('Exception getting share link {} ({}\n\tException Message: {}'.format(diruse, dirname, e))
+        logger.critical('Exception getting share link for {}\n\tException Message: {}'.format(dbxfolder, e))
         return ''
     else:
-        return share.url
+        with CACHELOCK:
+            SHAREURLCACHE[dbxfolder] = (shareurl, time.time() + OPTIONS['shareurlttl'])
+        return shareurl
 
-def check_for_cmd(slack, localuploadsource, dropboxtoken, slacktoken, slackchannel):
+def check_for_cmd(slack, localuploadsource, backend, slacktoken, slackchannel):
     '''
     Check Cloud drive for commands to run
     If a command file is found, delete it from the cloud and throw an exception if it fails
@@ -275,10 +1475,9 @@ def check_for_cmd(slack, localuploadsource, dropboxtoken, slacktoken, slackchann
     res = os.path.join(os.path.dirname(os.path.realpath(__file__)), response) #'/opt/sierra/data_diode/upload_data'
 
     write_response_file(response, 'w', 'Command Check Starting\n')
-    dbx = dropbox.Dropbox(dropboxtoken)
 
     try:
-        cmd = download(dbx, folder, subfolder, filename)
+        cmd = download(backend, folder, subfolder, filename)
         logger.info('Command file "{}" containing command "{}" found on cloud drive. Attempting to delete...'.format(path, cmd))
         write_response_file(response, 'a', 'Command received: \t{}\n'.format(cmd))
     except Exception as e:
@@ -287,12 +1486,12 @@ def check_for_cmd(slack, localuploadsource, dropboxtoken, slacktoken, slackchann
         return
 
     try:
-        delete_cloud_file(dbx, path)
+        delete_cloud_file(backend, path)
         write_response_file(response, 'a', 'Command file deleted: \t{}\n'.format(path))
     except Exception as e:
         logger.error('Command file "{}" could not be deleted. Command will not be processed.'.format(path))
         write_response_file(response, 'a', 'Command exception\t{}\n'.format(e))
-        upload(dbx, res, folder, subfolder, response, overwrite=True)
+        upload(backend, res, folder, subfolder, response, overwrite=True, priority=True)
         raise
 
     # Only process commands if the command file from the cloud can be deleted.
@@ -303,14 +1502,14 @@ def check_for_cmd(slack, localuploadsource, dropboxtoken, slacktoken, slackchann
         parsed_cmd = parse_cmd(cmd, slack, slackchannel)
     except Exception as e:
         write_response_file(response, 'a', 'Command exception\t{}\n'.format(e))
-        upload(dbx, res, folder, subfolder, response, overwrite=True)
+        upload(backend, res, folder, subfolder, response, overwrite=True, priority=True)
         raise
 
     write_response_file(response, 'a', 'Running command: \t{}\n'.format(parsed_cmd))
 
     # Copy file to upload folder
     try:
-        upload(dbx, res, folder, subfolder, response, overwrite=True)
+        upload(backend, res, folder, subfolder, response, overwrite=True, priority=True)
     except Exception as e:
         pass
 
@@ -326,7 +1525,7 @@ def check_for_cmd(slack, localuploadsource, dropboxtoken, slacktoken, slackchann
         write_response_file(response, 'a', '{}'.format(msg))
         logger.info(msg)
         postslackmsg(slack, '{}'.format(slackchannel), '{}'.format(msg), True)
-        upload(dbx, res, folder, subfolder, response, overwrite=True)
+        upload(backend, res, folder, subfolder, response, overwrite=True, priority=True)
 
     except Exception as e:
         postslackmsg(slack, '{}'.format(slackchannel), 'Exception running *{}* command "{}"'.format(cmd, parsed_cmd), True)
@@ -334,6 +1533,182 @@ def check_for_cmd(slack, localuploadsource, dropboxtoken, slacktoken, slackchann
 
     return
 
+class CutThrough(threading.Thread):
+    '''
+    Streams files into upload sessions while the receiver is still writing them
+    With cut-through enabled the receiver reports 'receiving' events giving the
+     number of bytes of its .part file already on disk.  Those bytes are
+     appended to an upload session recorded in the queue under the file's
+     final name, so by the time the file is verified and published most of it
+     is already uploaded and the normal upload only sends the rest and
+     commits.  Nothing is committed before the receiver has verified the
+     hash; a 'failed' event (hash mismatch) abandons the session.
+    Once a file is published its session belongs to the upload workers
+     (see handover) and is no longer appended to here.
+    '''
+
+    def __init__(self, backend, localuploadsource):
+        super(CutThrough, self).__init__()
+        self.daemon = True
+        self.backend = backend
+        self.rootdir = localuploadsource
+        self.events = six.moves.queue.Queue()
+        self.transfers = {} # Final file name -> transfer its upload session belongs to
+        self.published = set() # Final file names handed over to the upload workers
+        self.appending = None # Final file name of the append in progress
+        self.lock = threading.Condition()
+
+    def put(self, event):
+        self.events.put(event)
+
+    def handover(self, paths):
+        '''
+        Stop streaming the published [paths] so the upload workers own their sessions
+        Waits for an append already in progress for one of them (at most one
+         chunk); later events for them are ignored
+        '''
+        paths = [os.path.realpath(path) for path in paths]
+        with self.lock:
+            self.published.update(paths)
+            while self.appending in paths:
+                self.lock.wait()
+
+    @contextlib.contextmanager
+    def append(self, dest):
+        '''
+        Mark an append to the session of [dest] in progress
+        Yields False if the file has been handed over and must not be appended to
+        '''
+        with self.lock:
+            if dest in self.published:
+                yield False
+                return
+            self.appending = dest
+        try:
+            yield True
+        finally:
+            with self.lock:
+                self.appending = None
+                self.lock.notify_all()
+
+    def run(self):
+        while True:
+            event = self.events.get()
+            try:
+                if event['event'] == 'receiving':
+                    self.stream(event['path'], event['dest'], event['offset'], event.get('transfer'))
+                else:
+                    self.abandon(event['dest'])
+            except Exception as e:
+                logger.error('Exception handling cut-through event {}.\n\tException Message: {}'.format(event, e))
+
+    def stream(self, partfile, dest, offset, transfer):
+        rootdir = os.path.realpath(self.rootdir)
+        dest = os.path.realpath(dest)
+        if not dest.startswith(rootdir + os.path.sep) or os.path.basename(partfile) != os.path.basename(dest) + '.part':
+            logger.warning('Ignoring cut-through event for "{}" ("{}")'.format(dest, partfile))
+            return
+
+        if self.transfers.get(dest) != transfer:
+            # A new transfer of this file (or the uploader restarted) - start over
+            dn, name = os.path.split(dest)
+            if not isinstance(name, six.text_type):
+                name = name.decode('utf-8')
+            if not QUEUE.receiving(dest, os.path.join(PROJECTNAME, 'incoming'), dn[len(rootdir):].strip(os.path.sep), name):
+                logger.info('"{}" is already queued for upload. Not uploading it while it is received.'.format(dest))
+                return
+            with self.lock:
+                self.published.discard(dest)
+            QUEUE.savesession(dest, None)
+            self.transfers[dest] = transfer
+            logger.info('Cut-through upload of "{}" started'.format(dest))
+
+        with self.lock:
+            if dest in self.published:
+                return
+        if not BREAKER.closed():
+            return
+
+        session = QUEUE.getsession(dest)
+        try:
+            with open(partfile, 'rb') as f:
+                while session is None or session['offset'] < offset:
+                    start = 0 if session is None else session['offset']
+                    f.seek(start)
+                    data = f.read(min(SHAPER.chunksize(), offset - start))
+                    if not data:
+                        break
+                    SHAPER.consume(len(data))
+                    with self.append(dest) as owned:
+                        if not owned:
+                            return
+                        if session is None:
+                            session = {'session_id': self.backend.sessionstart(data), 'offset': len(data), 'size': None, 'mtime': None}
+                        else:
+                            self.backend.sessionappend(session['session_id'], start, data)
+                            session['offset'] += len(data)
+                        if not QUEUE.savesession(dest, session, 'receiving'):
+                            # Queued by a scan of the upload source before its event arrived
+                            return
+        except UploadOffsetError as err:
+            session['offset'] = err.offset
+            QUEUE.savesession(dest, session, 'receiving')
+        except StorageError as err:
+            logger.warning('Cut-through upload of "{}" failed ({}). It will be uploaded once published.'.format(dest, err))
+            QUEUE.savesession(dest, None, 'receiving')
+            self.transfers.pop(dest, None)
+        except StorageUnavailableError as err:
+            BREAKER.failure(err)
+        else:
+            logger.debug('Cut-through upload of "{}" at {:,} bytes'.format(dest, offset))
+
+    def abandon(self, dest):
+        dest = os.path.realpath(dest)
+        if self.transfers.pop(dest, None) is not None:
+            logger.warning('"{}" failed verification. Abandoning its cut-through upload.'.format(dest))
+            QUEUE.forget(dest)
+
+class CommandPoller(threading.Thread):
+    '''
+    Watches the cloud commands folder independently of the upload loop
+    Uses a long poll (files_list_folder_longpoll on Dropbox), which holds a
+     request open until the folder changes, so a command is picked up within
+     seconds and an idle folder costs no API calls.  If the folder cannot be
+     watched (e.g. it does not exist yet) the command file is checked every
+     [retrydelay] seconds instead.
+    '''
+
+    def __init__(self, slack, localuploadsource, backend, slacktoken, slackchannel, retrydelay):
+        super(CommandPoller, self).__init__()
+        self.daemon = True
+        self.args = (slack, localuploadsource, backend, slacktoken, slackchannel)
+        self.backend = backend
+        self.retrydelay = retrydelay
+
+    def run(self):
+        path = '/{}'.format(os.path.join(PROJECTNAME, 'commands'))
+        cursor = None
+
+        while True:
+            try:
+                if cursor is None:
+                    # Handle anything already waiting before watching for changes
+                    check_for_cmd(*self.args)
+                    cursor = self.backend.latestcursor(path)
+
+                changes, backoff = self.backend.longpoll(cursor, COMMANDPOLLTIMEOUT)
+                if changes:
+                    changes, cursor = self.backend.listfoldercontinue(cursor)
+                    if any(isinstance(entry, FileEntry) and name.lower() == 'command.txt' for name, entry in changes):
+                        check_for_cmd(*self.args)
+                if backoff:
+                    time.sleep(backoff)
+
+            except Exception as e:
+                logger.debug('Command folder watch on "{}" interrupted. Retrying in {} seconds.\n\tException Message: {}'.format(path, self.retrydelay, e))
+                cursor = None
+                time.sleep(self.retrydelay)
+
 def write_response_file(outputfile, filemode, filecontent):
     '''
     Writes data to a file (either append or write) with a timestamp
@@ -345,10 +1720,10 @@ def write_response_file(outputfile, filemode, filecontent):
     except Exception as e:
         raise
 
-def delete_cloud_file(dbx, path):
+def delete_cloud_file(backend, path):
     
     try:
-        dbx.files_delete(path)
+        backend.delete(path)
     except Exception as e:
         raise
 
@@ -401,28 +1776,76 @@ def parse_cmd(command, slack, slackchannel):
 
     return parsed_cmd
 
-def list_folder(dbx, folder, subfolder):
+def list_folder(backend, folder, subfolder, maxage=0):
     """List a folder.
     Return a dict mapping unicode filenames to
-    FileMetadata|FolderMetadata entries.
+    FileEntry|FolderEntry entries.
+    The listing is cached per folder and kept current with the folder's
+    cursor, so repeat calls only fetch what changed since the last call.
+    A cached listing updated less than maxage seconds ago is returned
+    without asking the server at all.  Files committed by this uploader
+    are added to the cached listing as they are uploaded (cacheentry).
     """
     path = '/%s/%s' % (folder, subfolder.replace(os.path.sep, '/'))
     while '//' in path:
         path = path.replace('//', '/')
     path = path.rstrip('/')
-    try:
-        with stopwatch('list_folder'):
-            res = dbx.files_list_folder(path)
-    except dropbox.exceptions.ApiError as err:
-        logger.debug('Folder listing failed for {} -- assumped empty: {}'.format(path, err))
-        return {}
-    else:
-        rv = {}
-        for entry in res.entries:
-            rv[entry.name] = entry
-        return rv
+    with listinglock(path):
+        with CACHELOCK:
+            cached = LISTINGCACHE.get(path)
+            if cached is not None and time.time() - cached['time'] < maxage:
+                return dict(cached['entries'])
+        try:
+            with stopwatch('list_folder'):
+                if cached is None or cached['cursor'] is None:
+                    entries, cursor = backend.listfolder(path)
+                else:
+                    entries = dict(cached['entries'])
+                    changes, cursor = backend.listfoldercontinue(cached['cursor'])
+                    for name, entry in changes:
+                        if entry is None:
+                            entries.pop(name, None)
+                        else:
+                            entries[name] = entry
+        except StorageError as err:
+            if cached is not None and cached['cursor'] is not None:
+                # Cursor reset or folder changed underneath us - list from scratch
+                logger.debug('Cached listing for {} could not be continued ({}) -- relisting'.format(path, err))
+                with CACHELOCK:
+                    LISTINGCACHE.pop(path, None)
+                return list_folder(backend, folder, subfolder, maxage)
+            logger.debug('Folder listing failed for {} -- assumped empty: {}'.format(path, err))
+            # Remember it (e.g. a folder a pending batch has yet to create) for maxage seconds
+            with CACHELOCK:
+                LISTINGCACHE[path] = {'cursor': None, 'entries': {}, 'time': time.time()}
+            return {}
+        else:
+            with CACHELOCK:
+                LISTINGCACHE[path] = {'cursor': cursor, 'entries': entries, 'time': time.time()}
+            return dict(entries)
+
+def listinglock(path):
+    '''
+    Lock held while the cached listing of folder [path] is refreshed or
+     updated, so concurrent workers wait for one refresh instead of each
+     listing the folder again
+    '''
+    with CACHELOCK:
+        return LISTINGLOCKS[path]
 
-def download(dbx, folder, subfolder, name):
+def cacheentry(path, entry):
+    '''
+    Record [entry], just committed at cloud [path], in the cached listing of
+     its folder so a later upload of the same name is not taken for a new file
+    '''
+    folderpath = path.rsplit('/', 1)[0]
+    with listinglock(folderpath):
+        with CACHELOCK:
+            cached = LISTINGCACHE.get(folderpath)
+            if cached is not None:
+                cached['entries'][entry.name] = entry
+
+def download(backend, folder, subfolder, name):
     """Download a file.
     Return the bytes of the file, or None if it doesn't exist.
     """
@@ -431,39 +1854,205 @@ def download(dbx, folder, subfolder, name):
         path = path.replace('//', '/')
     with stopwatch('download'):
         try:
-            md, res = dbx.files_download(path)
-        except dropbox.exceptions.HttpError as err:
+            data = backend.download(path)
+        except StorageUnavailableError as err:
             logger.warning('*** HTTP error: {}'.format(err))
             return None
-    data = res.content
-    logger.debug('File size: {} bytes;\tFile metadata: {}'.format(len(data), md))
+    logger.debug('File size: {} bytes'.format(len(data)))
     return data
 
-def upload(dbx, fullname, folder, subfolder, name, overwrite=False):
-    """Upload a file.
-    Return the request response, or None in case of error.
-    """
+def cloudpath(folder, subfolder, name):
     path = '/%s/%s/%s' % (folder, subfolder.replace(os.path.sep, '/'), name)
     while '//' in path:
         path = path.replace('//', '/')
-    mode = (dropbox.files.WriteMode.overwrite
-            if overwrite
-            else dropbox.files.WriteMode.add)
+    return path
+
+def upload(backend, fullname, folder, subfolder, name, overwrite=False, priority=False):
+    """Upload a file.
+    Files above the session threshold (UPLOADSESSIONTHRESHOLD, lower while
+    the upload rate is limited) are sent in chunks via an upload session.
+    Priority uploads (command responses) do not wait for the rate limit.
+    Return the FileEntry of the uploaded file, or None in case of error.
+    """
+    path = cloudpath(folder, subfolder, name)
     mtime = os.path.getmtime(fullname)
-    with open(fullname, 'rb') as f:
-        data = f.read()
-    with stopwatch('upload %d bytes' % len(data)):
+    size = os.path.getsize(fullname)
+    client_modified = datetime.datetime(*time.gmtime(mtime)[:6])
+    with stopwatch('upload %d bytes' % size):
         try:
-            res = dbx.files_upload(
-                data, path, mode,
-                client_modified=datetime.datetime(*time.gmtime(mtime)[:6]),
-                mute=True)
-        except dropbox.exceptions.ApiError as err:
+            if size > SHAPER.sessionthreshold() or QUEUE.getsession(fullname) is not None:
+                res = upload_session(backend, fullname, path, overwrite, client_modified, priority)
+            else:
+                with open(fullname, 'rb') as f:
+                    data = f.read()
+                SHAPER.consume(len(data), priority)
+                res = backend.upload(data, path, overwrite, client_modified)
+        except StorageError as err:
             logger.warning('*** API error: {}'.format(err))
             return None
     logger.info('Uploaded as {}'.format(res.name.encode('utf8')))
+    cacheentry(path, res)
+    return res
+
+def upload_session(backend, fullname, path, overwrite, client_modified, priority=False):
+    """Upload a large file through an upload session, CHUNKSIZE bytes at a time
+    (less while the upload rate is limited, see TokenBucket.chunksize).
+    Progress is saved in the upload queue after every chunk so an upload
+    interrupted by an error or a restart resumes from the last offset
+    committed by the server.
+    A session started by CutThrough holds bytes of the .part file as they
+    were received, so the committed file is checked against the content
+    hash of the published file and uploaded again if they differ.
+    Return the FileEntry of the committed file.
+    """
+    size = os.path.getsize(fullname)
+    mtime = os.path.getmtime(fullname)
+    session = QUEUE.getsession(fullname)
+    cutthrough = session is not None and session['size'] is None
+    if cutthrough:
+        if session['offset'] > size:
+            session, cutthrough = None, False
+        else:
+            session['size'], session['mtime'] = size, mtime
+    elif session is not None and (session['size'], session['mtime']) != (size, mtime):
+        logger.info('"{}" changed since its upload session started. Restarting upload.'.format(fullname))
+        session = None
+
+    with open(fullname, 'rb') as f:
+        if session is None:
+            data = f.read(SHAPER.chunksize())
+            SHAPER.consume(len(data), priority)
+            sessionid = backend.sessionstart(data)
+            session = {'session_id': sessionid, 'offset': f.tell(), 'size': size, 'mtime': mtime}
+            QUEUE.savesession(fullname, session)
+        else:
+            logger.info('Resuming upload of "{}" at offset {:,} of {:,} bytes'.format(fullname, session['offset'], size))
+
+        offset = session['offset']
+        while True:
+            f.seek(offset)
+            data = f.read(SHAPER.chunksize())
+            SHAPER.consume(len(data), priority)
+            try:
+                if offset + len(data) >= size:
+                    res = backend.sessionfinish(session['session_id'], offset, data, path, overwrite, client_modified)
+                    break
+                backend.sessionappend(session['session_id'], offset, data)
+            except UploadOffsetError as err:
+                logger.warning('Upload session for "{}" is at offset {:,} (expected {:,}). Resuming from server offset.'.format(fullname, err.offset, offset))
+                offset = err.offset
+            except StorageError:
+                # Session expired or unusable - start a new one next time
+                QUEUE.savesession(fullname, None)
+                raise
+            else:
+                offset += len(data)
+
+            session['offset'] = offset
+            QUEUE.savesession(fullname, session)
+
+    QUEUE.savesession(fullname, None)
+    if cutthrough and res.content_hash != contenthash(fullname):
+        logger.warning('Cut-through upload of "{}" does not match the received file. Uploading it again.'.format(fullname))
+        return upload_session(backend, fullname, path, True, client_modified, priority)
     return res
 
+def incorrectoffset(err):
+    """Return the offset the server expects if an upload session call
+    failed because of an offset mismatch, otherwise None.
+    """
+    error = err.error
+    if hasattr(error, 'is_lookup_failed') and error.is_lookup_failed():
+        error = error.get_lookup_failed()
+    if hasattr(error, 'is_incorrect_offset') and error.is_incorrect_offset():
+        return error.get_incorrect_offset().correct_offset
+    return None
+
+def contenthash(fullname):
+    """Compute the Dropbox content hash of a local file.
+    This is the SHA-256 of the concatenated SHA-256 digests of each
+    HASHBLOCKSIZE block, matching FileMetadata.content_hash.  Blocks are read
+    one at a time and hashed on up to OPTIONS['hashworkers'] threads
+    (hashlib releases the GIL), so memory use is bounded by the worker count.
+    """
+    blocks = (os.path.getsize(fullname) + HASHBLOCKSIZE - 1) // HASHBLOCKSIZE
+
+    def blockhash(index):
+        with open(fullname, 'rb') as f:
+            f.seek(index * HASHBLOCKSIZE)
+            return hashlib.sha256(f.read(HASHBLOCKSIZE)).digest()
+
+    with stopwatch('content hash'):
+        workers = min(OPTIONS['hashworkers'], blocks)
+        if workers > 1:
+            pool = ThreadPool(workers)
+            try:
+                digests = pool.map(blockhash, range(blocks))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            digests = [blockhash(index) for index in range(blocks)]
+
+    return hashlib.sha256(b''.join(digests)).hexdigest()
+
+class NullNotifier(object):
+    '''Stands in for SlackNotifier when nothing should be posted (benchmarks)'''
+
+    def add(self, dbxfolder, shareurl, filename):
+        pass
+
+    def flush(self):
+        pass
+
+    def alert(self, message):
+        pass
+
+    def close(self, timeout):
+        pass
+
+def benchmark(corpus, latency, bandwidth, errorrate):
+    '''
+    Replay a corpus of received files through the upload pipeline against the
+     LocalBackend stand-in and report files/s, bytes/s and API calls per file
+    The corpus is copied to a scratch folder first so it is left untouched
+    The run goes on until the queue is drained.  Outages caused by injected
+     errors are probed after [latency] seconds instead of the configured
+     probe delay; files still waiting for a retry at the end are reported as
+     failed and left out of the rates
+    '''
+
+    global PROJECTNAME, QUEUE, BREAKER, SHAPER
+    PROJECTNAME = 'benchmark'
+
+    workdir = tempfile.mkdtemp(prefix='fileuploader-benchmark-')
+    try:
+        source = os.path.join(workdir, 'outgoing')
+        shutil.copytree(corpus, source)
+        files = [os.path.join(dn, name) for dn, dirs, names in os.walk(source) for name in names]
+        totalbytes = sum(os.path.getsize(name) for name in files)
+        backend = LocalBackend(os.path.join(workdir, 'cloud'), latency, bandwidth, errorrate)
+        QUEUE = UploadQueue(os.path.join(workdir, 'queue.db'))
+        OPTIONS['breakerprobedelay'] = OPTIONS['breakermaxprobedelay'] = latency
+        BREAKER = CircuitBreaker()
+        SHAPER = TokenBucket(OPTIONS['uploadrate'])
+
+        logger.info('Benchmark: {:,} files ({:,} bytes) from "{}". Latency {}s, bandwidth {} B/s, error rate {}, options {}'.format(len(files), totalbytes, corpus, latency, bandwidth or 'unlimited', errorrate, OPTIONS))
+        starttime = time.time()
+        while True:
+            main(NullNotifier(), source, backend, '', '')
+            if BREAKER.closed() and not QUEUE.ready():
+                break
+            time.sleep(max(BREAKER.nextattempt() - time.time(), 0))
+        elapsed = max(time.time() - starttime, 1e-6)
+
+        remaining = [os.path.join(dn, name) for dn, dirs, names in os.walk(source) for name in names]
+        uploaded = len(files) - len(remaining)
+        uploadedbytes = totalbytes - sum(os.path.getsize(name) for name in remaining)
+        logger.info('Benchmark: {:,} of {:,} files uploaded ({:,} failed) in {:.1f}s - {:.2f} files/s, {:,.0f} bytes/s, {:.2f} API calls per file ({:,} calls)'.format(uploaded, len(files), len(remaining), elapsed, uploaded / elapsed, uploadedbytes / elapsed, float(backend.calls) / max(uploaded, 1), backend.calls))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
 def yesno(message, default, args):
     """Handy helper function to ask a yes/no question.
     Command line arguments --yes or --no force the answer;
@@ -516,17 +2105,34 @@ def stopwatch(message):
 
 if __name__ == '__main__':
 
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--config', default='/opt/sierra/data_diode/upload_data/fileuploader.cfg', help='Config file (default: %(default)s)')
+    parser.add_argument('--benchmark', metavar='CORPUS', help='Replay the files in CORPUS through the uploader against a local stand-in backend, report throughput and exit')
+    parser.add_argument('--latency', type=float, default=0.2, help='Benchmark: seconds added to every request (default: %(default)s)')
+    parser.add_argument('--bandwidth', type=float, default=0, help='Benchmark: transfer limit in bytes/s, 0 = unlimited (default: %(default)s)')
+    parser.add_argument('--error-rate', type=float, default=0, help='Benchmark: fraction of requests that fail, 0-1 (default: %(default)s)')
+    args = parser.parse_args()
+    if not 0 <= args.error_rate < 1:
+        parser.error('--error-rate must be at least 0 and less than 1')
+
+    if args.benchmark:
+        getoptions(args.config)
+        benchmark(args.benchmark, args.latency, args.bandwidth, args.error_rate)
+        sys.exit(0)
+
     pid, pidfile  = getpid()
     delay = 60
-    configfile = '/opt/sierra/data_diode/upload_data/fileuploader.cfg'
+    configfile = args.config
 
     logger.info('File Uploader starting with PID {}.  {} second delay between scans.'.format(pid, delay))
 
     while True:
         try:
             PROJECTNAME, localuploadsource, dropboxtoken, slacktoken, slackchannel, SLACKBOTNAME = getconfig(configfile)
+            getoptions(configfile)
             logger.info('Config file "{}" read successfully.'.format(configfile))
             logger.info('Project name: "{}", Upload Source: "{}", Slack channel: "{}", Slack Bot: "{}"'.format(PROJECTNAME, localuploadsource, slackchannel, SLACKBOTNAME))
+            logger.info('Uploader options: {}'.format(OPTIONS))
             if slackchannel[0] != '#':
                 logger.warning('Slack channel: "{}" may need to start with "#" to work properly. Prepending "#" on channel name.'.format(slackchannel))
                 slackchannel = '#{}'.format(slackchannel)
@@ -540,11 +2146,41 @@ if __name__ == '__main__':
 
     slack = Slacker(slacktoken)
     slack.chat.post_message(slackchannel, '*File Uploader starting with parameters:*\n\tProject name: *_{}_*\n\tUpload Source: *_{}_*'.format(PROJECTNAME, localuploadsource, slackchannel), SLACKBOTNAME)
+    notifier = SlackNotifier(slack, slackchannel)
+    notifier.start()
+    backend = DropboxBackend(dropboxtoken)
+    QUEUE = UploadQueue(OPTIONS['queuefile'])
+    BREAKER = CircuitBreaker()
+    SHAPER = TokenBucket(OPTIONS['uploadrate'])
+
+    # Files published by the receiver are uploaded as soon as they are reported.
+    # The full walk of the upload source only runs every reconcileinterval
+    # seconds to pick up anything that was missed.
+    events = openeventsocket(OPTIONS['eventsocket'])
+    lastscan = 0
+
+    # Files the receiver is still writing are uploaded as they arrive
+    cutthrough = CutThrough(backend, localuploadsource)
+    cutthrough.start()
+
+    # Commands are watched on their own thread so they never wait behind uploads
+    commands = CommandPoller(slack, localuploadsource, backend, slacktoken, slackchannel, delay)
+    commands.start()
 
     while True:
         try:
-            main(slack, localuploadsource, dropboxtoken, slacktoken, slackchannel)
-            check_for_cmd(slack, localuploadsource, dropboxtoken, slacktoken, slackchannel)
+            if time.time() - lastscan >= OPTIONS['reconcileinterval']:
+                main(notifier, localuploadsource, backend, slacktoken, slackchannel)
+                lastscan = time.time()
+
+            # During an outage queued files wait for the next connectivity probe
+            due = max(QUEUE.nextretry(), BREAKER.nextattempt())
+            timeout = min(lastscan + OPTIONS['reconcileinterval'], due) - time.time()
+            paths = waitforevents(events, timeout, cutthrough, notifier)
+            if paths:
+                logger.info('Receiver published {} file(s)'.format(len(paths)))
+            # Also runs (with no new paths) when only a queued retry has come due
+            main(notifier, localuploadsource, backend, slacktoken, slackchannel, paths or [])
 
         except KeyboardInterrupt as e:
             logger.warning('Keyboard Interrupt. Exiting program...\n\tException Message: {}'.format(e))        
@@ -552,12 +2188,11 @@ if __name__ == '__main__':
             break
         
         except Exception as e:
+            # Connection failures are handled by BREAKER, so keep running
+            # rather than exit into a restart loop
             logger.critical('Exception in main loop. Restarting...\n\tException Message: {}'.format(e))
-            if e.args[1].args[0].errno == errno.ECONNRESET:
-                logger.critical('ECONNRESET - exiting program')
-                break
-            
-        time.sleep(delay)
+            time.sleep(delay)
 
+    notifier.close(30)
     os.unlink(pidfile)
     slack.chat.post_message(slackchannel, 'File Uploader stopping.')